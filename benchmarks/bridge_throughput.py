@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Compares PlugApi event throughput when consumed through a ThreadBridge,
+against consuming the events on the event loop itself.
+
+The same fake plug as in loop_throughput.py streams a fixed number of
+instant_power messages over UDP on the loopback interface. In the 'asyncio'
+pass the events are counted by an async handler; in the 'bridge' pass the
+PlugApi runs on the bridge thread and the events are counted by a consumer
+thread calling get_many(). Reports wall time, CPU time (of the whole
+process, i.e. both threads) and events/second.
+
+Usage: python benchmarks/bridge_throughput.py [--messages N] [--batch N]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = str(Path(__file__).parents[1] / 'src')
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+BENCHMARKS = str(Path(__file__).parent)
+if BENCHMARKS not in sys.path:
+    sys.path.append(BENCHMARKS)
+
+# pylint: disable=C0413
+from loop_throughput import MAC, FakePlug, make_message, measure
+from powersensor_local.thread_bridge import ThreadBridge
+
+def measure_bridge(count, batch):
+    """Runs one benchmark pass through a ThreadBridge, returning
+    (events, wall_s, cpu_s)."""
+    messages = [make_message(i) for i in range(count)]
+    with ThreadBridge() as bridge:
+        async def serve():
+            loop = asyncio.get_running_loop()
+            return await loop.create_datagram_endpoint(
+                lambda: FakePlug(messages), local_addr=('127.0.0.1', 0))
+        transport, _ = bridge.run_coroutine(serve())
+        port = transport.get_extra_info('sockname')[1]
+
+        received = 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        bridge.add_plug(MAC, '127.0.0.1', port, events=['average_power'])
+        while received < count:
+            # Stop once progress stalls, i.e. datagrams were dropped
+            got = bridge.get_many(batch, timeout=1)
+            if not got:
+                break
+            received += len(got)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        bridge.run_coroutine(_close(transport))
+    return received, wall, cpu
+
+async def _close(transport):
+    transport.close()
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='max_items per get_many() call')
+    args = parser.parse_args()
+
+    print(f"{'consumer':10} {'events':>8} {'wall s':>8} {'cpu s':>8} {'events/s':>10}")
+    events, wall, cpu = asyncio.run(measure(args.messages))
+    print(f"{'asyncio':10} {events:8} {wall:8.3f} {cpu:8.3f} {events / wall:10.0f}")
+    events, wall, cpu = measure_bridge(args.messages, args.batch)
+    print(f"{'bridge':10} {events:8} {wall:8.3f} {cpu:8.3f} {events / wall:10.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""Tracks the import time of the package against a budget.
+
+Each measurement runs in a fresh interpreter, so nothing is cached in
+sys.modules. The median over several runs is compared against the budget,
+and the script exits non-zero if any budget is exceeded.
+
+Usage: python benchmarks/import_time.py [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SRC = str(Path(__file__).parents[1] / 'src')
+
+# (description, statement, budget in milliseconds)
+BUDGETS = [
+    ('import powersensor_local', 'import powersensor_local', 30),
+    ('access PlugApi', 'import powersensor_local; powersensor_local.PlugApi', 150),
+    ('access PowersensorDevices',
+     'import powersensor_local; powersensor_local.PowersensorDevices', 150),
+]
+
+TIMER = '''
+import time
+t = time.perf_counter()
+{stmt}
+print((time.perf_counter() - t) * 1000)
+'''
+
+def measure(stmt: str, runs: int) -> float:
+    """Returns the median time in milliseconds to execute stmt in a fresh
+    interpreter."""
+    env = dict(os.environ, PYTHONPATH=SRC)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', TIMER.format(stmt=stmt)],
+            env=env, check=True, capture_output=True, text=True)
+        samples.append(float(out.stdout))
+    return statistics.median(samples)
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'measurement':30} {'median ms':>10} {'budget ms':>10}")
+    for desc, stmt, budget in BUDGETS:
+        ms = measure(stmt, args.runs)
+        over = ms > budget
+        failed |= over
+        print(f"{desc:30} {ms:10.1f} {budget:10}{'  OVER BUDGET' if over else ''}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
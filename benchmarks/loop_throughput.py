@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""Compares PlugApi event throughput across event loop implementations.
+
+A fake plug on the loopback interface streams a fixed number of
+instant_power messages to a PlugApi over UDP, within the same event loop,
+so every loop implementation handles an identical load. Reports wall time,
+CPU time and events/second per loop.
+
+Usage: python benchmarks/loop_throughput.py [--messages N] [--loops asyncio,uvloop]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = str(Path(__file__).parents[1] / 'src')
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+# pylint: disable=C0413
+from powersensor_local.abstract_event_handler import loop_factory
+from powersensor_local.plug_api import PlugApi
+
+MAC = 'aabbccddeeff'
+# Messages sent per loop iteration. The standard selector datagram transport
+# reads one datagram per iteration, so larger values overflow the socket.
+CHUNK = 1
+
+def make_message(i):
+    """A plug instant_power message, as sent by the firmware."""
+    return json.dumps({
+        'type': 'instant_power', 'device': 'plug', 'mac': MAC,
+        'starttime': 1700000000 + i, 'duration': 1.0, 'unit': 'w',
+        'power': 100 + i % 50, 'summation': i, 'summation_start': 1700000000,
+        'current': 0.5, 'active_current': 0.4, 'reactive_current': 0.1,
+        'voltage': 240.0,
+    }).encode('utf-8') + b'\n'
+
+class FakePlug(asyncio.DatagramProtocol):
+    """Streams the messages once a subscription request arrives."""
+    def __init__(self, messages):
+        self._messages = messages
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.startswith(b'subscribe(60)'):
+            asyncio.create_task(self._stream(addr))
+
+    async def _stream(self, addr):
+        for i, message in enumerate(self._messages):
+            self._transport.sendto(message, addr)
+            if i % CHUNK == 0:
+                await asyncio.sleep(0)
+
+async def measure(count):
+    """Runs one benchmark pass, returning (events, wall_s, cpu_s)."""
+    loop = asyncio.get_running_loop()
+    messages = [make_message(i) for i in range(count)]
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: FakePlug(messages), local_addr=('127.0.0.1', 0))
+    port = transport.get_extra_info('sockname')[1]
+
+    received = 0
+    done = asyncio.Event()
+    async def on_event(_, __):
+        nonlocal received
+        received += 1
+        if received >= count:
+            done.set()
+
+    api = PlugApi(MAC, '127.0.0.1', port)
+    api.subscribe('average_power', on_event)
+    wall, cpu = time.perf_counter(), time.process_time()
+    api.connect()
+    last = -1
+    while received != last and not done.is_set():
+        # Stop once progress stalls, i.e. datagrams were dropped
+        last = received
+        try:
+            await asyncio.wait_for(done.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    await api.disconnect()
+    transport.close()
+    return received, wall, cpu
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--loops', default='asyncio,uvloop')
+    args = parser.parse_args()
+
+    print(f"{'loop':10} {'events':>8} {'wall s':>8} {'cpu s':>8} {'events/s':>10}")
+    for name in args.loops.split(','):
+        try:
+            factory = loop_factory(name)
+        except RuntimeError as e:
+            print(f"{name:10} skipped: {e}")
+            continue
+        with asyncio.Runner(loop_factory=factory) as runner:
+            events, wall, cpu = runner.run(measure(args.messages))
+        print(f"{name:10} {events:8} {wall:8.3f} {cpu:8.3f} {events / wall:10.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -15,11 +15,28 @@ A legacy abstraction is also provided via PowersensorDevices, which uses
 an older way of discovering plugs, and then funnels all the event streams
 through a single callback.
 
+Consumers which do not run an asyncio event loop themselves can use
+ThreadBridge, which runs the above on a dedicated event loop thread.
+
+To get around the subscription limits when several local tools need the same
+event stream, a FanoutServer can hold the subscriptions and re-publish the
+events to any number of FanoutClients.
+
+Consumers which only need the current state of each device can keep a
+DeviceStateStore up to date, rather than tracking the events themselves.
+SnapshotServer serves that state, along with a household view, over HTTP.
+
 Lower-level interfaces are available in the PlugListenerUdp and PlugListenerTcp
 classes, though they are not recommended for general use.
 
 Additionally, a convenience abstraction for translating some of the events into
-a household view is available in VirtualHousehold.
+a household view is available in VirtualHousehold. When many sites are handled
+in one process, HouseholdManager routes events to one VirtualHousehold per site.
+EnergyIntegrator maintains continuous per-device energy totals, which are
+unaffected by summation resets and missing summations. WindowedStats keeps
+rolling per-device statistics over time windows, e.g. for alerting, and
+RuleEngine evaluates threshold rules against the event stream. To find out
+how stale events are by the time they are handled, attach a LatencyTracer.
 
 Quick overview:
 • PlugApi is the recommended API layer
@@ -27,24 +44,93 @@ Quick overview:
 • PlugListenerTcp is the TCP lower-level abstraction used by PlugApi
 • PowersensorDevices is the legacy main API layer
 • LegacyDiscovery provides access to the legacy discovery mechanism
+• ThreadBridge hands events to threads not running an asyncio loop
+• FanoutServer/FanoutClient share one event stream among many local clients
+• DeviceStateStore holds the latest readings of every device
+• SnapshotServer serves device and household state to HTTP pollers
 • VirtualHousehold can be used to translate events into a household view
+• HouseholdManager routes events to many VirtualHousehold instances
+• EnergyIntegrator integrates power into energy and reconciles it
+• WindowedStats keeps rolling per-device mean/min/max/stddev
+• RuleEngine/Rule evaluate indexed threshold rules, with hold and hysteresis
+• LatencyTracer records per-device latency histograms, device to handler
 
 The 'plugevents' and 'rawplug' modules are helper utilities provided as
 debug aids, which get installed under the names ps-plugevents and ps-rawplug
 respectively. There is also the legacy 'events' debug aid which get installed
 nder the names ps-events, and offers up the events from PowersensorDevices.
 """
+import importlib
+from typing import TYPE_CHECKING
+
 __all__ = [
-    'VirtualHousehold',
+    'DeviceStateStore',
+    'EnergyIntegrator',
+    'FanoutClient',
+    'FanoutServer',
+    'HouseholdManager',
+    'LatencyTracer',
+    'LegacyDiscovery',
     'PlugApi',
-    '__version__',
     'PlugListenerTcp',
-    'PlugListenerUdp'
+    'PlugListenerUdp',
+    'PowersensorDevices',
+    'Rule',
+    'RuleEngine',
+    'SnapshotServer',
+    'ThreadBridge',
+    'VirtualHousehold',
+    'WindowedStats',
+    '__version__',
 ]
 __version__ = "2.1.0"
-from .devices import PowersensorDevices
-from .legacy_discovery import LegacyDiscovery
-from .plug_api import PlugApi
-from .plug_listener_tcp import PlugListenerTcp
-from .plug_listener_udp import PlugListenerUdp
-from .virtual_household import VirtualHousehold
+
+# Public names, and the submodules providing them. These are only imported
+# on first access, to keep the cost of importing the package itself low.
+_LAZY_ATTRS = {
+    'DeviceStateStore': 'state_store',
+    'EnergyIntegrator': 'energy',
+    'FanoutClient': 'fanout',
+    'FanoutServer': 'fanout',
+    'HouseholdManager': 'household_manager',
+    'LatencyTracer': 'tracing',
+    'LegacyDiscovery': 'legacy_discovery',
+    'PlugApi': 'plug_api',
+    'PlugListenerTcp': 'plug_listener_tcp',
+    'PlugListenerUdp': 'plug_listener_udp',
+    'PowersensorDevices': 'devices',
+    'Rule': 'rules',
+    'RuleEngine': 'rules',
+    'SnapshotServer': 'http_snapshot',
+    'ThreadBridge': 'thread_bridge',
+    'VirtualHousehold': 'virtual_household',
+    'WindowedStats': 'window_stats',
+}
+
+def __getattr__(name):
+    module = _LAZY_ATTRS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
+if TYPE_CHECKING:
+    from .devices import PowersensorDevices
+    from .energy import EnergyIntegrator
+    from .fanout import FanoutClient, FanoutServer
+    from .http_snapshot import SnapshotServer
+    from .household_manager import HouseholdManager
+    from .legacy_discovery import LegacyDiscovery
+    from .plug_api import PlugApi
+    from .plug_listener_tcp import PlugListenerTcp
+    from .plug_listener_udp import PlugListenerUdp
+    from .rules import Rule, RuleEngine
+    from .state_store import DeviceStateStore
+    from .thread_bridge import ThreadBridge
+    from .tracing import LatencyTracer
+    from .virtual_household import VirtualHousehold
+    from .window_stats import WindowedStats
@@ -1,20 +1,67 @@
 """Common helper for small commandline utils."""
+import argparse
 import asyncio
 import signal
+import sys
 from abc import ABC, abstractmethod
 
+LOOP_CHOICES = ('auto', 'asyncio', 'uvloop')
+EXIT_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+def loop_factory(loop: str = 'auto'):
+    """Return an event loop factory for the named loop implementation.
+
+    Parameters
+    ----------
+    loop : {'auto', 'asyncio', 'uvloop'}, optional
+        ``'asyncio'`` selects the standard library loop, ``'uvloop'`` requires
+        uvloop to be installed, and ``'auto'`` uses uvloop when it is
+        installed and the standard loop otherwise.
+
+    Returns
+    -------
+    callable | None
+        A factory suitable for :class:`asyncio.Runner`, or ``None`` for the
+        default loop.
+
+    Raises
+    ------
+    ValueError
+        If *loop* is not one of :data:`LOOP_CHOICES`.
+    RuntimeError
+        If ``'uvloop'`` was requested but is not installed.
+    """
+    if loop not in LOOP_CHOICES:
+        raise ValueError(f'Unsupported loop: {loop}')
+    if loop == 'asyncio':
+        return None
+    try:
+        import uvloop # pylint: disable=C0415
+    except ImportError as e:
+        if loop == 'uvloop':
+            raise RuntimeError('uvloop is not installed') from e
+        return None
+    return uvloop.new_event_loop
+
+def add_loop_argument(parser: argparse.ArgumentParser):
+    """Add the ``--loop`` option for selecting the event loop implementation."""
+    parser.add_argument(
+        '--loop', choices=LOOP_CHOICES, default='auto',
+        help='event loop implementation (default: uvloop if installed)')
+
 class AbstractEventHandler(ABC):
     """Base class to handle signals and the asyncio loop.
 
     Subclasses must implement :py:meth:`on_exit` and :py:meth:`main`.  The
-    ``run`` method starts an event loop, registers a SIGINT handler and
-    executes the :py:meth:`main` coroutine.  The loop is stopped when a
-    SIGINT is received and the :py:meth:`on_exit` coroutine has finished.
+    ``run`` method starts an event loop and executes the :py:meth:`main`
+    coroutine, which should register the SIGINT/SIGTERM handlers.  The loop
+    is stopped when one of those signals is received and the
+    :py:meth:`on_exit` coroutine has finished.
     """
     exiting: bool = False
     @abstractmethod
     async def on_exit(self):
-        """Called when a SIGINT is received.
+        """Called when a SIGINT or SIGTERM is received.
 
         Subclasses should override this method to perform any cleanup
         (e.g. closing connections, flushing buffers).  It is awaited before
@@ -23,11 +70,13 @@ class AbstractEventHandler(ABC):
 
     async def _do_exit(self):
         """Internal helper that runs ``on_exit`` and marks the handler as
-        exiting.  This coroutine is scheduled by :py:meth:`__handle_sigint`
-        when a SIGINT signal arrives.
+        exiting.  This coroutine is scheduled by :py:meth:`__handle_signal`
+        when an exit signal arrives.
         """
-        await self.on_exit()
-        self.exiting = True
+        try:
+            await self.on_exit()
+        finally:
+            self.exiting = True
 
     @abstractmethod
     async def main(self):
@@ -40,38 +89,51 @@ class AbstractEventHandler(ABC):
 
     # Signal handler for Ctrl+C
     def register_sigint_handler(self):
-        """Register the SIGINT (Ctrl‑C) handler.
+        """Register the SIGINT (Ctrl‑C) and SIGTERM handlers.
 
-        This method sets :py:meth:`__handle_sigint` as the callback for
-        ``signal.SIGINT``.  It should be called before :py:meth:`run` if
-        a custom handler is required.
+        The handlers are registered with the running event loop, so this
+        must be called from within :py:meth:`main`.  Where the loop does not
+        support signal handlers (e.g. on Windows), plain signal handlers
+        which hand over to the loop are used instead.
         """
-        signal.signal(signal.SIGINT, self.__handle_sigint)
+        loop = asyncio.get_running_loop()
+        for signum in EXIT_SIGNALS:
+            try:
+                loop.add_signal_handler(signum, self.__handle_signal, signum)
+            except NotImplementedError:
+                signal.signal(
+                    signum,
+                    lambda s, _: loop.call_soon_threadsafe(self.__handle_signal, s))
+
+    register_signal_handlers = register_sigint_handler
 
-    def __handle_sigint(self, signum, frame):
-        """Internal SIGINT callback.
+    def __handle_signal(self, signum):
+        """Internal exit signal callback, run in the event loop.
 
-        Prints diagnostic information and schedules :py:meth:`_do_exit`
-        as a task in the running event loop.  After the first SIGINT
-        the default handler is restored to allow a second Ctrl‑C to
+        Schedules :py:meth:`_do_exit` as a task.  After the first signal
+        the default handlers are restored to allow a second Ctrl‑C to
         terminate immediately.
         """
-        print(f"\nReceived signal: {signum}")
-        print(f"Signal name: {signal.Signals(signum).name}")
-        print(f"Interrupted at: {frame.f_code.co_filename}:{frame.f_lineno}")
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        asyncio.create_task(self._do_exit())
-
-    def run(self):
-        """Start the event loop and execute :py:meth:`main`.
-
-        A new event loop is created, the SIGINT handler is registered,
-        and :py:meth:`main` is run with ``asyncio.run``.  The loop is
-        stopped once the coroutine completes (normally or after a SIGINT).
+        # Keep stdout clean for the event output
+        print(f"\nReceived signal: {signal.Signals(signum).name}", file=sys.stderr)
+        loop = asyncio.get_running_loop()
+        for sig in EXIT_SIGNALS:
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                signal.signal(sig, signal.SIG_DFL)
+        loop.create_task(self._do_exit())
+
+    def run(self, loop: str = 'auto'):
+        """Start an event loop and execute :py:meth:`main`.
+
+        Parameters
+        ----------
+        loop : {'auto', 'asyncio', 'uvloop'}, optional
+            The event loop implementation to use; see :func:`loop_factory`.
         """
-        loop = asyncio.new_event_loop()
-        asyncio.run(self.main())
-        loop.stop()
+        with asyncio.Runner(loop_factory=loop_factory(loop)) as runner:
+            runner.run(self.main())
 
     async def wait(self, seconds=1):
         """Keep the event loop alive until a SIGINT is received.
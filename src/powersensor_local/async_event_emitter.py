@@ -1,5 +1,12 @@
-"""Small helper class for pub/sub functionality with async handlers."""
-from typing import Callable
+"""Small helper classes for pub/sub functionality with async handlers."""
+import asyncio
+import time
+from typing import Any, Callable, Hashable, Iterable, Optional, Union
+
+from powersensor_local import tracing
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+CONFLATE_POLICIES = ('merge', 'drop')
 
 class AsyncEventEmitter:
     """Small helper class for pub/sub functionality with async handlers."""
@@ -21,6 +28,59 @@ class AsyncEventEmitter:
         if callback in self._listeners[event_name]:
             self._listeners[event_name].remove(callback)
 
+    def has_listeners(self, event_name: str) -> bool:
+        """Returns whether any event handler is registered for the given
+        event type. Useful for skipping the construction of costly events."""
+        return bool(self._listeners.get(event_name))
+
+    def stream(self, events: Iterable[str], maxsize: int = 1000,
+               overflow: str = 'drop_oldest') -> 'EventStream':
+        """Returns an EventStream receiving the given event types, for use as
+
+        async for name, ev in emitter.stream(['average_power']):
+            ...
+
+        See EventStream for the meaning of maxsize and overflow."""
+        events = list(events)
+        stream = EventStream(maxsize, overflow)
+        for name in events:
+            self.subscribe(name, stream.push)
+        def unsubscribe_all():
+            for name in events:
+                self.unsubscribe(name, stream.push)
+        stream.on_close = unsubscribe_all
+        return stream
+
+    # pylint: disable=R0913
+    def subscribe_conflated(self, events: Union[str, Iterable[str]],
+                            callback: Callable, *, interval_s: float = None,
+                            max_rate: float = None, overflow: str = 'merge',
+                            key: Callable = None,
+                            merge: Callable = None) -> 'Conflator':
+        """Registers an event handler which receives the given event types
+        at a reduced rate, e.g. only the latest 'average_power' per device
+        every 5 seconds:
+
+        emitter.subscribe_conflated('average_power', handler, interval_s=5)
+
+        or at most 2 events per second, dropping the excess:
+
+        emitter.subscribe_conflated(
+            ['average_power'], handler, max_rate=2, overflow='drop')
+
+        See Conflator for the parameters. The handler is unsubscribed again
+        by closing the returned Conflator."""
+        events = [events] if isinstance(events, str) else list(events)
+        conflator = Conflator(callback, interval_s, max_rate, overflow, key,
+                              merge, emitter=self)
+        for name in events:
+            self.subscribe(name, conflator.push)
+        def unsubscribe_all():
+            for name in events:
+                self.unsubscribe(name, conflator.push)
+        conflator.on_close = unsubscribe_all
+        return conflator
+
     async def emit(self, event_name: str, *args):
         """Emits an event to all registered listeners for that event type.
         Additional arguments may be supplied with event as appropriate. Each
@@ -29,8 +89,288 @@ class AsyncEventEmitter:
         to an 'exception' event being emitted. This can chain."""
         if self._listeners.get(event_name) is None:
             return
+        trace = tracing.current_trace.get() if tracing.active else None
+        if trace is not None and (not args or args[0] is not trace.event):
+            trace = None
         for callback in self._listeners[event_name]:
+            if trace is not None:
+                trace.tracer.on_handler(trace)
             try:
                 await callback(event_name, *args)
             except BaseException as e: # pylint: disable=W0718
                 await self.emit('exception', e)
+
+
+class EventProcessorMixin:
+    """Adds attach()/detach() to classes which consume events through a
+    process_event(event_name, ev) handler. The events subscribed to are the
+    keys of self._processors, a dict of event name -> processor."""
+
+    def attach(self, emitter: AsyncEventEmitter):
+        """Subscribes to the relevant events on e.g. a PlugApi instance."""
+        for name in self._processors:
+            emitter.subscribe(name, self.process_event)
+
+    def detach(self, emitter: AsyncEventEmitter):
+        """Reverses attach()."""
+        for name in self._processors:
+            emitter.unsubscribe(name, self.process_event)
+
+
+class EventStream:
+    """An async iterator over events, decoupling the consumer from the emitter.
+
+    Each stream has its own bounded queue of (event_name, payload) tuples,
+    so a slow consumer does not stall event ingestion. When the queue is
+    full, the overflow policy applies:
+
+      - 'drop_oldest': The oldest queued event is discarded.
+      - 'drop_newest': The incoming event is discarded.
+      - 'block': The emitter waits for space (i.e. backpressure). Closing
+        the stream releases it, discarding the event.
+
+    The number of discarded events is available in 'lagged'. Consumers may
+    batch by draining whatever is queued with get_nowait() or drain().
+    """
+
+    _CLOSED = object()
+
+    def __init__(self, maxsize: int = 1000, overflow: str = 'drop_oldest',
+                 on_close: Optional[Callable] = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unsupported overflow policy: {overflow}')
+        self._queue = asyncio.Queue(maxsize)
+        self._overflow = overflow
+        self._closed = False
+        self._close_waiter = None # for pushes blocked on a full queue
+        self.on_close = on_close
+        self.lagged = 0
+
+    async def push(self, event_name: str, *args):
+        """Queues an event. Has the signature of an AsyncEventEmitter
+        handler, so may be subscribed directly."""
+        if self._closed:
+            return
+        item = (event_name, args[0] if len(args) == 1 else (args or None))
+        queue = self._queue
+        if not queue.full():
+            queue.put_nowait(item)
+        elif self._overflow == 'block':
+            await self._put_blocking(item)
+        elif self._overflow == 'drop_oldest':
+            queue.get_nowait()
+            queue.put_nowait(item)
+            self.lagged += 1
+        else:
+            self.lagged += 1
+
+    async def _put_blocking(self, item):
+        # Waits for space, or for close(), in which case the item is dropped
+        if self._close_waiter is None:
+            self._close_waiter = asyncio.get_running_loop().create_future()
+        put = asyncio.ensure_future(self._queue.put(item))
+        try:
+            await asyncio.wait((put, self._close_waiter),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+
+    def get_nowait(self):
+        """Returns the next queued (event_name, payload) without waiting.
+        Raises asyncio.QueueEmpty if there is none."""
+        item = self._queue.get_nowait()
+        if item is self._CLOSED:
+            raise asyncio.QueueEmpty
+        return item
+
+    def drain(self, max_items: Optional[int] = None) -> list:
+        """Returns up to max_items queued events (all if None), without
+        waiting."""
+        out = []
+        while max_items is None or len(out) < max_items:
+            try:
+                out.append(self.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return out
+
+    def close(self):
+        """Stops the stream. Events already queued may still be consumed,
+        after which iteration ends."""
+        if self._closed:
+            return
+        self._closed = True
+        if self.on_close is not None:
+            self.on_close()
+        if self._close_waiter is not None:
+            self._close_waiter.set_result(None)
+        if self._queue.empty():
+            self._queue.put_nowait(self._CLOSED)
+
+    @property
+    def closed(self) -> bool:
+        """Whether close() has been called."""
+        return self._closed
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self._queue.empty():
+            raise StopAsyncIteration
+        item = await self._queue.get()
+        if item is self._CLOSED:
+            raise StopAsyncIteration
+        return item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+def conflation_key(event_name: str, payload: Any) -> Hashable:
+    """The default Conflator key; the event name and the device MAC address
+    (if the payload has one)."""
+    if isinstance(payload, dict):
+        return (event_name, payload.get('mac'))
+    return (event_name, None)
+
+class Conflator:
+    """Reduces the rate of events handed to a handler, keeping only the
+    newest pending event per key (by default per event type and device).
+
+    With interval_s, pending events are delivered every interval_s seconds,
+    i.e. each key is delivered at most once per interval, with its latest
+    value.
+
+    With max_rate, events are delivered straight away while at most max_rate
+    events per second have been delivered. Beyond that, the overflow policy
+    applies:
+
+      - 'merge': The event becomes the pending event for its key, replacing
+        any older one, and pending events are delivered as the rate allows.
+      - 'drop': The event is discarded.
+
+    If merge is given, it is called as merge(older, newer) with the payloads
+    of two events for the same key, and returns the payload to keep (the
+    newer by default).
+
+    The number of events replaced or discarded is available in 'conflated'
+    and 'dropped' respectively. Exceptions raised by the handler during a
+    timed delivery are emitted as 'exception' events on the emitter, if any.
+    """
+
+    # pylint: disable=R0902,R0913,R0917
+    def __init__(self, callback: Callable, interval_s: Optional[float] = None,
+                 max_rate: Optional[float] = None, overflow: str = 'merge',
+                 key: Optional[Callable] = None, merge: Optional[Callable] = None,
+                 emitter: Optional[AsyncEventEmitter] = None,
+                 on_close: Optional[Callable] = None):
+        if (interval_s is None) == (max_rate is None):
+            raise ValueError('Exactly one of interval_s and max_rate is required')
+        if overflow not in CONFLATE_POLICIES:
+            raise ValueError(f'Unsupported overflow policy: {overflow}')
+        self._callback = callback
+        self._interval_s = interval_s
+        self._spacing = 1 / max_rate if max_rate is not None else None
+        self._overflow = overflow
+        self._key = key if key is not None else conflation_key
+        self._merge = merge
+        self._emitter = emitter
+        self._pending = {} # key -> (event_name, args)
+        self._next_at = 0.0 # when the next event may be delivered
+        self._timer = None
+        self._closed = False
+        self.on_close = on_close
+        self.conflated = 0
+        self.dropped = 0
+
+    async def push(self, event_name: str, *args):
+        """Handles an event. Has the signature of an AsyncEventEmitter
+        handler, so may be subscribed directly."""
+        if self._closed:
+            return
+        if self._spacing is not None and not self._pending:
+            now = time.monotonic()
+            if now >= self._next_at:
+                self._next_at = now + self._spacing
+                await self._callback(event_name, *args)
+                return
+            if self._overflow == 'drop':
+                self.dropped += 1
+                return
+        payload = args[0] if len(args) == 1 else None
+        k = self._key(event_name, payload)
+        pending = self._pending
+        older = pending.get(k)
+        if older is not None:
+            self.conflated += 1
+            if self._merge is not None and len(args) == 1:
+                args = (self._merge(older[1][0], payload),)
+        pending[k] = (event_name, args)
+        if self._timer is None:
+            self._arm()
+
+    async def flush(self):
+        """Delivers all pending events now, regardless of the rate."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending = self._pending
+        self._pending = {}
+        for event_name, args in pending.values():
+            await self._callback(event_name, *args)
+
+    def close(self):
+        """Unsubscribes, and discards any pending events. Call flush() first
+        to deliver them instead."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending.clear()
+        if self.on_close is not None:
+            self.on_close()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _arm(self):
+        loop = asyncio.get_running_loop()
+        if self._spacing is None:
+            delay = self._interval_s
+        else:
+            delay = max(self._next_at - time.monotonic(), 0)
+        self._timer = loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.create_task(self._deliver_pending())
+
+    async def _deliver_pending(self):
+        try:
+            if self._spacing is None:
+                await self.flush()
+                return
+            # One event per slot, oldest key first
+            pending = self._pending
+            if not pending:
+                return
+            k = next(iter(pending))
+            event_name, args = pending.pop(k)
+            self._next_at = time.monotonic() + self._spacing
+            if pending and self._timer is None:
+                self._arm()
+            await self._callback(event_name, *args)
+        except Exception as e: # pylint: disable=W0718
+            if self._emitter is None:
+                raise
+            await self._emitter.emit('exception', e)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""End-to-end throughput benchmark against fake plugs on the loopback
+interface. Intended for sizing collector hosts, not for use against real
+devices.
+
+The fake plugs run in a separate process, so the reported CPU time and
+peak RSS are those of the collector side only (PlugApi/PowersensorDevices,
+plus VirtualHousehold if selected). Each plug relays for one house-net
+sensor, interleaving its own reports with the sensor's. Message start times
+are stamped at send time, so the ingest-to-handler latency can be derived
+from each event's starttime_utc. With PowersensorDevices, readings with the
+same start time are dropped as duplicates, so the per-device rate must stay
+below 1000 messages/s (i.e. 2000 per plug) for the latencies to be valid.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import statistics
+import sys
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+PROJECT_ROOT = str(Path(__file__).parents[1])
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+# pylint: disable=C0413
+from powersensor_local.abstract_event_handler import add_loop_argument, loop_factory
+from powersensor_local.devices import PowersensorDevices
+from powersensor_local.plug_api import PlugApi, PLUG_EVENTS
+from powersensor_local.virtual_household import VirtualHousehold
+
+PORT = 49476
+TICK_S = 0.005
+
+### Fake plug side, run in a separate process ###
+
+class _FakePlug: # pylint: disable=R0902
+    """Generates plug and relayed sensor messages for its subscribers."""
+    def __init__(self, index, unique):
+        self.unique = unique
+        self.mac = f'fa4e00{index:06x}'
+        self.sensor_mac = f'fa5e00{index:06x}'
+        self.udp_subscribers = set()
+        self.tcp_writers = set()
+        self._transport = None
+        self._seq = 0
+        self._last = {}
+
+    def _starttime(self, mac):
+        # If unique, strictly increasing per device at the 1 ms resolution
+        # kept by translate_raw_message, so readings are never seen as
+        # duplicates. Beyond 1000 messages/s per device this runs ahead of
+        # the clock, and the latencies derived from it become meaningless.
+        now = time.time()
+        if not self.unique:
+            return now
+        now = max(now, self._last.get(mac, 0) + 0.001)
+        self._last[mac] = now
+        return now
+
+    def make_message(self):
+        """Returns the next message, alternating between the plug's own
+        report and a report relayed for its sensor."""
+        self._seq += 1
+        seq = self._seq
+        if seq % 2:
+            message = {
+                'type': 'instant_power', 'device': 'plug', 'mac': self.mac,
+                'starttime': self._starttime(self.mac), 'duration': 1.0,
+                'unit': 'w', 'power': 100 + seq % 50, 'summation': seq,
+                'summation_start': 1700000000, 'current': 0.5,
+                'active_current': 0.4, 'reactive_current': 0.1,
+                'voltage': 240.0,
+            }
+        else:
+            message = {
+                'type': 'instant_power', 'device': 'sensor', 'role': 'house-net',
+                'mac': self.sensor_mac,
+                'starttime': self._starttime(self.sensor_mac), 'duration': 1.0,
+                'unit': 'w', 'power': 2000 + seq % 500, 'summation': seq * 10,
+                'summation_start': 1700000000, 'batteryMicrovolt': 3900000,
+                'rssi': -70.0, 'raw_rssi': -71,
+            }
+        return json.dumps(message).encode('utf-8') + b'\n'
+
+    @property
+    def subscribed(self):
+        """Whether anyone is subscribed to this plug."""
+        return bool(self.udp_subscribers or self.tcp_writers)
+
+    def send_one(self):
+        """Sends the next message to all subscribers."""
+        data = self.make_message()
+        for addr in self.udp_subscribers:
+            self._transport.sendto(data, addr)
+        for writer in self.tcp_writers:
+            writer.write(data)
+
+    # UDP support
+    def connection_made(self, transport):
+        """DatagramProtocol support."""
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        """DatagramProtocol support."""
+        if data.startswith(b'subscribe(0)'):
+            self.udp_subscribers.discard(addr)
+        elif data.startswith(b'subscribe('):
+            self.udp_subscribers.add(addr)
+
+    def error_received(self, exc):
+        """DatagramProtocol support."""
+
+    def connection_lost(self, exc):
+        """DatagramProtocol support."""
+
+    # TCP support
+    async def on_tcp_client(self, reader, writer):
+        """Stream server client handler."""
+        try:
+            while line := await reader.readline():
+                if line.startswith(b'subscribe('):
+                    self.tcp_writers.add(writer)
+        except ConnectionError:
+            pass
+        self.tcp_writers.discard(writer)
+
+class _DiscoveryResponder(asyncio.DatagramProtocol):
+    """Answers legacy discovery requests on behalf of all fake plugs."""
+    def __init__(self, plugs):
+        self._plugs = plugs
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.startswith(b'discover()'):
+            for ip, plug in self._plugs:
+                self._transport.sendto(
+                    json.dumps({ 'ip': ip, 'mac': plug.mac }).encode(), addr)
+
+async def _generate(conn, proto, addrs, discovery): # pylint: disable=R0914
+    loop = asyncio.get_running_loop()
+    plugs = []
+    servers = []
+    endpoints = []
+    for i, (host, port) in enumerate(addrs):
+        plug = _FakePlug(i, discovery)
+        if proto == 'udp':
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda p=plug: p, local_addr=(host, port))
+            port = transport.get_extra_info('sockname')[1]
+        else:
+            server = await asyncio.start_server(plug.on_tcp_client, host, port)
+            port = server.sockets[0].getsockname()[1]
+            servers.append(server)
+        plugs.append((host, plug))
+        endpoints.append((host, port, plug.mac))
+    if discovery:
+        await loop.create_datagram_endpoint(
+            lambda: _DiscoveryResponder(plugs), local_addr=('127.0.0.1', PORT))
+    conn.send(endpoints)
+
+    rate = 0
+    sent = 0
+    budget = 0.0
+    last = time.perf_counter()
+    turn = 0
+    while True:
+        while conn.poll():
+            cmd = conn.recv()
+            conn.send(sent)
+            sent = 0
+            if cmd is None:
+                await _close(plugs, servers)
+                return
+            rate = cmd
+        now = time.perf_counter()
+        budget += rate * (now - last)
+        last = now
+        active = [plug for _, plug in plugs if plug.subscribed]
+        if not active:
+            budget = 0.0
+        for _ in range(int(budget)):
+            active[turn % len(active)].send_one()
+            turn += 1
+            sent += 1
+        budget -= int(budget)
+        await asyncio.sleep(TICK_S)
+
+async def _close(plugs, servers):
+    for server in servers:
+        server.close()
+    for _, plug in plugs:
+        for writer in plug.tcp_writers:
+            writer.close()
+    # Let the client handlers see EOF and finish
+    await asyncio.sleep(0.1)
+
+def _generator_main(conn, proto, addrs, discovery):
+    asyncio.run(_generate(conn, proto, addrs, discovery))
+
+### Collector side ###
+
+class _Collector:
+    """Counts handled events and their ingest-to-handler latencies."""
+    def __init__(self):
+        self.events = 0
+        self.latencies = []
+        self.household = None
+
+    def reset(self):
+        """Starts a new measurement step."""
+        self.events = 0
+        self.latencies = []
+
+    def on_event(self, name, ev):
+        """Records an event."""
+        self.events += 1
+        if name == 'average_power':
+            self.latencies.append(time.time() - ev['starttime_utc'])
+
+    async def on_plug_event(self, name, ev):
+        """PlugApi event handler."""
+        self.on_event(name, ev)
+        if self.household is not None:
+            await self._to_household(name, ev)
+
+    async def on_devices_event(self, obj):
+        """PowersensorDevices event handler."""
+        self.on_event(obj['event'], obj)
+        if self.household is not None:
+            await self._to_household(obj['event'], obj)
+
+    async def _to_household(self, name, ev):
+        if name == 'average_power':
+            await self.household.process_average_power_event(ev)
+        elif name == 'summation_energy':
+            await self.household.process_summation_event(ev)
+
+def _peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, but in bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def _percentile(samples, pct):
+    if len(samples) < 2:
+        return samples[0] if samples else float('nan')
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+async def _recv(conn):
+    return await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+
+def _kernel_drops(apis):
+    drops = [api.kernel_drops for api in apis]
+    if any(d is None for d in drops):
+        return float('nan')
+    return sum(drops)
+
+async def _attach(args, collector, endpoints):
+    """Returns the coroutine function to detach, and the PlugApi instances."""
+    if args.target == 'plugapi':
+        apis = []
+        for host, port, mac in endpoints:
+            api = PlugApi(mac, host, port, args.proto,
+                          rcvbuf=args.rcvbuf, drain=args.drain)
+            for name in PLUG_EVENTS:
+                api.subscribe(name, collector.on_plug_event)
+            api.connect()
+            apis.append(api)
+        async def stop():
+            for api in apis:
+                await api.disconnect()
+        return stop, apis
+
+    devices = PowersensorDevices('127.0.0.1')
+    async def on_event(obj):
+        if obj['event'] == 'device_found':
+            devices.subscribe(obj['mac'])
+        await collector.on_devices_event(obj)
+    await devices.start(on_event)
+    return devices.stop, devices.plugs.values()
+
+async def run(args):
+    """Runs the benchmark as configured by the commandline arguments."""
+    if args.target == 'devices':
+        # PowersensorDevices only knows the default port, so each fake plug
+        # needs its own loopback address.
+        addrs = [(f'127.0.0.{2 + i}', PORT) for i in range(args.plugs)]
+    else:
+        addrs = [('127.0.0.1', 0)] * args.plugs
+    conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=_generator_main, daemon=True,
+        args=(child_conn, args.proto, addrs, args.target == 'devices'))
+    proc.start()
+    endpoints = await _recv(conn)
+
+    collector = _Collector()
+    if args.household:
+        collector.household = VirtualHousehold(False)
+    stop, apis = await _attach(args, collector, endpoints)
+    await asyncio.sleep(1) # Allow subscriptions to settle
+
+    print(f"{'target/s':>9} {'sent/s':>9} {'events/s':>9} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'cpu %':>6} {'rss MB':>7} {'drops':>7}")
+    try:
+        for rate in args.rates:
+            conn.send(rate)
+            await _recv(conn)
+            collector.reset()
+            wall, cpu = time.perf_counter(), time.process_time()
+            await asyncio.sleep(args.step_s)
+            conn.send(rate)
+            sent = await _recv(conn)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            lat_ms = [s * 1000 for s in collector.latencies]
+            print(f"{rate:9} {sent / wall:9.0f} {collector.events / wall:9.0f} "
+                  f"{_percentile(lat_ms, 50):8.1f} {_percentile(lat_ms, 99):8.1f} "
+                  f"{100 * cpu / wall:6.1f} {_peak_rss_mb():7.1f} "
+                  f"{_kernel_drops(apis):7}")
+    finally:
+        conn.send(None)
+        await _recv(conn)
+        await stop()
+        proc.join(5)
+
+def app():
+    """Application entry point."""
+    parser = argparse.ArgumentParser(
+        description='Measure end-to-end event throughput against fake plugs '
+                    'on the loopback interface.')
+    parser.add_argument(
+        '--target', choices=('plugapi', 'devices'), default='plugapi',
+        help='attach PlugApi instances directly, or use PowersensorDevices '
+             '(requires the 127.0.0.0/8 loopback range, as on Linux)')
+    parser.add_argument('--proto', choices=('udp', 'tcp'), default='udp',
+                        help='transport for PlugApi (devices always uses udp)')
+    parser.add_argument('--plugs', type=int, default=10,
+                        help='number of fake plugs (default: 10)')
+    parser.add_argument(
+        '--rates', default=[1000, 2000, 5000, 10000, 20000],
+        type=lambda v: [int(r) for r in v.split(',')],
+        help='comma-separated total message rates to step through')
+    parser.add_argument('--step-s', type=float, default=5.0,
+                        help='seconds to measure each rate for (default: 5)')
+    parser.add_argument('--drain', action='store_true',
+                        help='read all ready datagrams per wakeup (PlugApi, udp)')
+    parser.add_argument('--rcvbuf', type=int, metavar='BYTES',
+                        help='UDP socket receive buffer size (PlugApi only)')
+    parser.add_argument('--household', action='store_true',
+                        help='also feed the events through a VirtualHousehold')
+    add_loop_argument(parser)
+    args = parser.parse_args()
+    if args.target == 'devices':
+        args.proto = 'udp'
+    with asyncio.Runner(loop_factory=loop_factory(args.loop)) as runner:
+        runner.run(run(args))
+
+if __name__ == "__main__":
+    app()
@@ -1,40 +1,74 @@
 """Abstraction interface for unified event stream from Powersensor devices"""
 import asyncio
-import sys
+import time
 
+from collections import OrderedDict
 from datetime import datetime, timezone
-from pathlib import Path
-PROJECT_ROOT = str(Path(__file__).parents[1])
-if PROJECT_ROOT not in sys.path:
-    sys.path.append(PROJECT_ROOT)
+from types import MappingProxyType
 
-# pylint: disable=C0413
+from powersensor_local.async_event_emitter import EventStream
 from powersensor_local.legacy_discovery import LegacyDiscovery
 from powersensor_local.plug_api import PlugApi
 
 EXPIRY_CHECK_INTERVAL_S = 30
 EXPIRY_TIMEOUT_S = 5 * 60
+RELAY_STALE_S = 2 * 60
+DEDUP_SIZE = 4096
 
+# pylint: disable=R0902
 class PowersensorDevices:
     """Abstraction interface for the unified event stream from all Powersensor 
     devices on the local network.
     """
 
-    def __init__(self, bcast_addr='<broadcast>'):
-        """Creates a fresh instance, without scanning for devices."""
+    def __init__(self, bcast_addr='<broadcast>', dedup_size=DEDUP_SIZE,
+                 state_store=None):
+        """Creates a fresh instance, without scanning for devices.
+
+        When a sensor is within range of several plugs, each of them relays
+        its readings. Only the first copy of each reading, as identified by
+        (mac, event, starttime_utc), is passed on. The most recently seen
+        dedup_size such keys are remembered.
+
+        If a DeviceStateStore is given, it's kept up to date with all
+        devices, whether subscribed to or not.
+        """
         self._event_cb = None
         self._discovery = LegacyDiscovery(bcast_addr)
         self._devices = {}
         self._timer = None
         self._plug_apis = {}
-
-    async def start(self, async_event_cb):
+        self._plugs_view = MappingProxyType(self._plug_apis)
+        self._dedup_size = dedup_size
+        self._recent = OrderedDict()
+        self.duplicates_dropped = 0
+        self._streams = []
+        self._batch = None
+        self._batch_size = 0
+        self._batch_latency_s = 0
+        self._batch_timer = None
+        self._state_store = state_store
+
+    async def start(self, async_event_cb=None, batch_size=0, batch_latency_s=0):
         """Registers the async event callback function and starts the scan
         of the local network to discover present devices. The callback is
         of the form
 
         async def yourcallback(event: dict)
 
+        The callback may be omitted if events are consumed via stream()
+        instead.
+
+        If batch_size is non-zero, events are instead collected and the
+        callback is invoked with a list of events,
+
+        async def yourcallback(events: list)
+
+        once batch_size events have been collected, or batch_latency_s
+        seconds after the first event of a batch, whichever comes first. A
+        latency of zero delivers everything collected within one event loop
+        iteration as a single batch.
+
         Known events:
 
         scan_complete:
@@ -60,7 +94,8 @@ class PowersensorDevices:
 
 
         Additionally, all events described in xlatemsg.translate_raw_message
-        may be issued. The event name is inserted into the field 'event'.
+        may be issued, as well as the 'no_longer_relaying_for' event described
+        in PlugApi. The event name is inserted into the field 'event'.
 
 
         The start function returns the number of found gateway plugs.
@@ -69,6 +104,9 @@ class PowersensorDevices:
         a plug via long-range radio.
         """
         self._event_cb = async_event_cb
+        self._batch_size = batch_size
+        self._batch_latency_s = batch_latency_s
+        self._batch = [] if batch_size > 0 else None
         await self._on_scanned(await self._discovery.scan())
         self._timer = self._Timer(EXPIRY_CHECK_INTERVAL_S, self._on_timer)
         return len(self._plug_apis)
@@ -83,12 +121,32 @@ class PowersensorDevices:
         To restart the event streaming, call start() again."""
         for plug in self._plug_apis.values():
             await plug.disconnect()
-        self._plug_apis = {}
+        self._plug_apis.clear()
+        await self._flush_batch()
         self._event_cb = None
+        self._batch = None
+        for _, stream in list(self._streams):
+            stream.close()
         if self._timer:
             self._timer.terminate()
             self._timer = None
 
+    def stream(self, events=None, maxsize=1000, overflow='drop_oldest'):
+        """Returns an EventStream of (event_name, event) tuples, for use as
+
+        async for name, ev in devices.stream(['average_power']):
+            ...
+
+        The events are the same as those delivered to the start() callback.
+        If events is None, all events are included. Each stream has its own
+        bounded queue; see EventStream for the overflow policies. Streams are
+        closed by stop()."""
+        names = None if events is None else frozenset(events)
+        entry = (names, EventStream(maxsize, overflow))
+        self._streams.append(entry)
+        entry[1].on_close = lambda: self._streams.remove(entry)
+        return entry[1]
+
     def subscribe(self, mac):
         """Subscribes to events from the device with the given MAC address."""
         device = self._devices.get(mac)
@@ -101,23 +159,124 @@ class PowersensorDevices:
         if device:
             device.subscribed = False
 
-    async def _emit_if_subscribed(self, ev, obj):
+    async def _deliver(self, obj):
+        for names, stream in self._streams:
+            if names is None or obj['event'] in names:
+                await stream.push(obj['event'], obj)
         if self._event_cb is None:
             return
+        if self._batch is None:
+            await self._event_cb(obj)
+            return
+        self._batch.append(obj)
+        if len(self._batch) >= self._batch_size:
+            await self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(
+                self._batch_latency_s, self._on_batch_timer)
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        asyncio.create_task(self._flush_batch())
+
+    async def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if not self._batch or self._event_cb is None:
+            return
+        batch = self._batch
+        self._batch = []
+        await self._event_cb(batch)
+
+    async def _emit_if_subscribed(self, ev, obj):
+        if self._event_cb is None and not self._streams:
+            return
         device = self._devices.get(obj.get('mac'))
         if device is not None and device.subscribed:
-            obj['event'] = ev
-            await self._event_cb(obj)
+            # The event dict is shared with other subscribers of the PlugApi
+            await self._deliver(dict(obj, event=ev))
+
+    @property
+    def state_store(self):
+        """The DeviceStateStore kept up to date, if any."""
+        return self._state_store
+
+    @property
+    def plugs(self):
+        """A read-only live mapping of plug MAC address to its PlugApi, e.g.
+        for inspecting the per-plug reconnects and malformed counters."""
+        return self._plugs_view
+
+    def best_relay(self, mac):
+        """Returns the MAC address of the plug best placed to relay for the
+        given sensor, based on recently reported RSSI, or None if unknown."""
+        device = self._devices.get(mac)
+        if device is None:
+            return None
+        return device.best_relay()
+
+    def redundant_plugs(self):
+        """Returns the set of plugs which are not themselves subscribed to,
+        and which are not the best relay for any subscribed sensor. The data
+        from these plugs is currently entirely redundant."""
+        needed = set()
+        for device in self._devices.values():
+            if not device.subscribed:
+                continue
+            if device.mac in self._plug_apis:
+                needed.add(device.mac)
+            else:
+                needed.add(device.best_relay())
+        return set(self._plug_apis) - needed
+
+    async def prune_redundant_plugs(self):
+        """Disconnects from the plugs reported by redundant_plugs(), to reduce
+        network and CPU load. Note that this removes the fail-over should the
+        best relay for a sensor go away. Pruned plugs will expire, and are
+        then reconnected to on the next rescan()."""
+        for mac in self.redundant_plugs():
+            api = self._plug_apis.pop(mac)
+            await api.disconnect()
+
+    def _is_duplicate(self, ev, obj):
+        starttime = obj.get('starttime_utc')
+        if starttime is None:
+            return False
+        key = (obj['mac'], ev, starttime)
+        recent = self._recent
+        if key in recent:
+            recent.move_to_end(key)
+            self.duplicates_dropped += 1
+            return True
+        recent[key] = None
+        if len(recent) > self._dedup_size:
+            recent.popitem(last=False)
+        return False
 
     async def _reemit(self, ev, obj):
         mac = obj['mac']
         device = self._devices.get(mac)
+        if ev == 'no_longer_relaying_for':
+            if device is not None:
+                device.forget_relay(obj.get('via'))
+            if self._state_store is not None:
+                self._state_store.update(ev, obj)
+            await self._emit_if_subscribed(ev, obj)
+            return
         if device is not None:
             device.mark_active()
+            via = obj.get('via')
+            if via is not None:
+                device.mark_relay(via, obj.get('average_rssi'))
 
         if ev == 'now_relaying_for':
             await self._add_device(mac, 'sensor')
-        else:
+            if self._state_store is not None:
+                self._state_store.update(ev, obj)
+        elif not self._is_duplicate(ev, obj):
+            if self._state_store is not None:
+                self._state_store.update(ev, obj)
             await self._emit_if_subscribed(ev, obj)
 
     async def _on_scanned(self, found):
@@ -133,13 +292,14 @@ class PowersensorDevices:
                 api.subscribe('average_power_components', self._reemit)
                 api.subscribe('battery_level', self._reemit)
                 api.subscribe('exception', self._reemit)
+                api.subscribe('no_longer_relaying_for', self._reemit)
                 api.subscribe('now_relaying_for', self._reemit)
                 api.subscribe('radio_signal_quality', self._reemit)
                 api.subscribe('summation_energy', self._reemit)
                 api.subscribe('summation_volume', self._reemit)
                 api.connect()
 
-        await self._event_cb({
+        await self._deliver({
             'event': 'scan_complete',
             'gateway_count': len(found),
         })
@@ -154,16 +314,20 @@ class PowersensorDevices:
         if mac in self._devices:
             return
         self._devices[mac] = self._Device(mac)
-        await self._event_cb({
+        if self._state_store is not None:
+            self._state_store.add(mac, typ)
+        await self._deliver({
             'event': 'device_found',
             'mac': mac,
-            'device_type:': typ,
+            'device_type': typ,
         })
 
     async def _remove_device(self, mac):
         if mac in self._devices:
             self._devices.pop(mac)
-            await self._event_cb({
+            if self._state_store is not None:
+                self._state_store.remove(mac)
+            await self._deliver({
                 'event': 'device_lost',
                 'mac': mac,
             })
@@ -175,11 +339,47 @@ class PowersensorDevices:
             self.mac = mac
             self.subscribed = False
             self._last_active = datetime.now(timezone.utc)
+            self._relays = {}
+            self._best_relay = None
 
         def mark_active(self):
             """Updates the last activity time to prevent expiry."""
             self._last_active = datetime.now(timezone.utc)
 
+        def mark_relay(self, via, rssi):
+            """Records a sighting through the given relay, along with its
+            reported RSSI (if any), and re-evaluates the best relay."""
+            prev = self._relays.get(via)
+            if rssi is None and prev is not None:
+                rssi = prev[0]
+            self._relays[via] = (rssi, time.monotonic())
+            self._best_relay = None
+
+        def forget_relay(self, via):
+            """Forgets a relay which is no longer relaying for the device."""
+            if self._relays.pop(via, None) is not None:
+                self._best_relay = None
+
+        def best_relay(self):
+            """Returns the relay with the best recent RSSI. Relays which have
+            not been heard from recently are forgotten. Among relays without
+            a known RSSI, the most recently seen one is preferred."""
+            if self._best_relay is not None:
+                return self._best_relay
+            now = time.monotonic()
+            best = None
+            best_rank = None
+            for via, (rssi, seen) in list(self._relays.items()):
+                if now - seen > RELAY_STALE_S:
+                    del self._relays[via]
+                    continue
+                rank = (rssi is not None, rssi if rssi is not None else 0, seen)
+                if best_rank is None or rank > best_rank:
+                    best = via
+                    best_rank = rank
+            self._best_relay = best
+            return best
+
         def has_expired(self):
             """Checks whether the last activity time is past the expiry."""
             now = datetime.now(timezone.utc)
@@ -0,0 +1,263 @@
+"""Continuous per-device energy totals, integrated from average power."""
+from typing import Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter, EventProcessorMixin
+
+GAP_TOLERANCE_S = 0.5
+MAX_BRIDGE_S = 5 * 60
+
+class DeviceEnergy: # pylint: disable=R0902
+    """The integration and reconciliation state of a single device.
+
+    integrated_joules The sum of watts * duration_s over all readings, plus
+      the bridged gaps.
+    reported_joules The reported summation_joules, made continuous across
+      summation resets, or None if no summation has been seen.
+    """
+    __slots__ = (
+        'mac', 'integrated_joules', 'readings', 'late', 'last_end_utc',
+        'last_watts', 'gaps', 'gap_s', 'bridged_joules', 'unbridged_s',
+        'resettime_utc', 'last_summation', 'summation_offset', 'summation_utc',
+        'resets', 'integrated_at_summation', 'readings_at_summation',
+        'anchor_integrated', 'anchor_reported',
+    )
+
+    def __init__(self, mac: str):
+        self.mac = mac
+        self.integrated_joules = 0.0
+        self.readings = 0
+        self.late = 0
+        self.last_end_utc = None
+        self.last_watts = None
+        self.gaps = 0
+        self.gap_s = 0.0
+        self.bridged_joules = 0.0
+        self.unbridged_s = 0.0
+        self.resettime_utc = None
+        self.last_summation = None
+        self.summation_offset = 0.0
+        self.summation_utc = None
+        self.resets = 0
+        self.integrated_at_summation = 0.0
+        self.readings_at_summation = 0
+        self.anchor_integrated = None
+        self.anchor_reported = None
+
+    @property
+    def reported_joules(self) -> Optional[float]:
+        """The continuous reported summation, as of the last summation."""
+        if self.last_summation is None:
+            return None
+        return self.summation_offset + self.last_summation
+
+    @property
+    def energy_joules(self) -> float:
+        """The best estimate of the total energy: the continuous reported
+        summation where available, plus what has been integrated since."""
+        reported = self.reported_joules
+        if reported is None:
+            return self.integrated_joules
+        return reported + self.integrated_joules - self.integrated_at_summation
+
+    @property
+    def drift_joules(self) -> Optional[float]:
+        """By how much the integrated energy exceeds the reported energy,
+        since the first summation seen, as of the last summation."""
+        if self.anchor_reported is None:
+            return None
+        return ((self.integrated_at_summation - self.anchor_integrated)
+                - (self.reported_joules - self.anchor_reported))
+
+    @property
+    def drift_ratio(self) -> Optional[float]:
+        """drift_joules relative to the reported energy over the same span."""
+        drift = self.drift_joules
+        if drift is None:
+            return None
+        span = self.reported_joules - self.anchor_reported
+        return drift / span if span else None
+
+    def as_dict(self) -> dict:
+        """Returns the totals and counters as a dict."""
+        return {
+            'mac': self.mac,
+            'energy_joules': self.energy_joules,
+            'integrated_joules': self.integrated_joules,
+            'reported_joules': self.reported_joules,
+            'drift_joules': self.drift_joules,
+            'drift_ratio': self.drift_ratio,
+            'readings': self.readings,
+            'late': self.late,
+            'gaps': self.gaps,
+            'gap_s': self.gap_s,
+            'bridged_joules': self.bridged_joules,
+            'unbridged_s': self.unbridged_s,
+            'resets': self.resets,
+        }
+
+class EnergyIntegrator(EventProcessorMixin, AsyncEventEmitter):
+    """
+    Integrates average_power events (watts * duration_s) into a continuous
+    energy total per device, and reconciles it against the summation_energy
+    events where those are available (they are missing on older firmware).
+
+    Unlike the summations, and the VirtualHousehold counters derived from
+    them, the totals are not affected by summation resets: on a reset, the
+    energy since the previous summation is taken from the integration, and
+    the reported summation continues from there. Likewise, short gaps in
+    the average_power readings (up to max_bridge_s) are bridged using the
+    mean of the power either side of the gap. Readings overlapping the
+    previous one, e.g. copies relayed by a second plug, are counted as late
+    and ignored.
+
+    The work per event is constant; no history is kept. Energies are signed,
+    as are the readings, so e.g. export shows as negative house-net energy.
+
+    The integrator may be subscribed directly to one or more PlugApi
+    instances (see attach()), or fed via process_event(). The current totals
+    are available from totals(). The following events are emitted, but only
+    while they have subscribers:
+
+    * energy_reconciled: On each summation_energy event, with the payload
+      { mac: , timestamp_utc: , energy_joules: , integrated_joules: ,
+        reported_joules: , drift_joules: , drift_ratio: }
+    * energy_gap: When a gap in the readings is detected, with the payload
+      { mac: , start_utc: , end_utc: , bridged_joules: } where
+      bridged_joules is None if the gap was too long to bridge.
+    * summation_reset: When a device's summation is reset, with the payload
+      { mac: , timestamp_utc: , summation_resettime_utc: , bridged_joules: }
+    """
+
+    def __init__(self, gap_tolerance_s: float = GAP_TOLERANCE_S,
+                 max_bridge_s: float = MAX_BRIDGE_S):
+        """Constructor.
+        gap_tolerance_s How far apart consecutive readings may be, in either
+          direction, while still being considered contiguous.
+        max_bridge_s The longest gap in readings which is bridged.
+        """
+        super().__init__()
+        self._gap_tolerance_s = gap_tolerance_s
+        self._max_bridge_s = max_bridge_s
+        self._devices = {}
+        self._processors = {
+            'average_power': self.process_average_power_event,
+            'summation_energy': self.process_summation_event,
+        }
+
+    def device(self, mac: str) -> Optional[DeviceEnergy]:
+        """Returns the live state for the given device, if known."""
+        return self._devices.get(mac)
+
+    def totals(self) -> dict:
+        """Returns the totals and counters of all devices, keyed by MAC."""
+        return { mac: dev.as_dict() for mac, dev in self._devices.items() }
+
+    async def process_event(self, event_name: str, ev: dict):
+        """Ingests an 'average_power' or 'summation_energy' event. Other
+        events are ignored."""
+        processor = self._processors.get(event_name)
+        if processor is not None:
+            await processor(ev)
+
+    def _device(self, mac: str) -> DeviceEnergy:
+        dev = self._devices.get(mac)
+        if dev is None:
+            dev = self._devices[mac] = DeviceEnergy(mac)
+        return dev
+
+    async def process_average_power_event(self, ev: dict):
+        """Ingests an event of type 'average_power'."""
+        mac = ev.get('mac')
+        start = ev.get('starttime_utc')
+        watts = ev.get('watts')
+        duration = ev.get('duration_s')
+        if mac is None or start is None or watts is None or not duration:
+            return
+        dev = self._device(mac)
+        if dev.last_end_utc is not None:
+            gap = start - dev.last_end_utc
+            if gap < -self._gap_tolerance_s:
+                dev.late += 1
+                return
+            if gap > self._gap_tolerance_s:
+                await self._on_gap(dev, gap, watts)
+        dev.integrated_joules += watts * duration
+        dev.readings += 1
+        dev.last_end_utc = start + duration
+        dev.last_watts = watts
+
+    async def _on_gap(self, dev: DeviceEnergy, gap: float, watts: float):
+        dev.gaps += 1
+        dev.gap_s += gap
+        if gap <= self._max_bridge_s:
+            bridged = (dev.last_watts + watts) / 2 * gap
+            dev.integrated_joules += bridged
+            dev.bridged_joules += bridged
+        else:
+            bridged = None
+            dev.unbridged_s += gap
+        if self.has_listeners('energy_gap'):
+            await self.emit('energy_gap', {
+                'mac': dev.mac,
+                'start_utc': dev.last_end_utc,
+                'end_utc': dev.last_end_utc + gap,
+                'bridged_joules': bridged,
+            })
+
+    async def process_summation_event(self, ev: dict):
+        """Ingests an event of type 'summation_energy'."""
+        mac = ev.get('mac')
+        summation = ev.get('summation_joules')
+        if mac is None or summation is None:
+            return
+        timestamp = ev.get('starttime_utc')
+        resettime = ev.get('summation_resettime_utc')
+        dev = self._device(mac)
+        if dev.summation_utc is not None and timestamp is not None \
+                and timestamp <= dev.summation_utc:
+            dev.late += 1
+            return
+
+        if dev.last_summation is None:
+            dev.anchor_integrated = dev.integrated_joules
+            dev.anchor_reported = summation
+        elif resettime != dev.resettime_utc or summation < dev.last_summation:
+            # Continue the reported total from its previous value, plus the
+            # energy since then: integrated if there were readings, else
+            # whatever has been counted since the reset
+            continued = dev.reported_joules
+            if dev.readings != dev.readings_at_summation:
+                continued += dev.integrated_joules - dev.integrated_at_summation
+                bridged = continued - dev.reported_joules
+            else:
+                continued += summation
+                bridged = None
+            dev.summation_offset = continued - summation
+            dev.resets += 1
+            if self.has_listeners('summation_reset'):
+                await self.emit('summation_reset', {
+                    'mac': mac,
+                    'timestamp_utc': timestamp,
+                    'summation_resettime_utc': resettime,
+                    'bridged_joules': bridged,
+                })
+
+        dev.resettime_utc = resettime
+        dev.last_summation = summation
+        dev.summation_utc = timestamp
+        dev.integrated_at_summation = dev.integrated_joules
+        dev.readings_at_summation = dev.readings
+
+        if self.has_listeners('energy_reconciled'):
+            await self.emit('energy_reconciled', {
+                'mac': mac,
+                'timestamp_utc': timestamp,
+                'energy_joules': dev.energy_joules,
+                'integrated_joules': dev.integrated_joules,
+                'reported_joules': dev.reported_joules,
+                'drift_joules': dev.drift_joules,
+                'drift_ratio': dev.drift_ratio,
+            })
+
+    def __len__(self):
+        return len(self._devices)
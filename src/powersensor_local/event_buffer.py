@@ -1,5 +1,5 @@
 """A simple fixed‑size buffer that stores event dictionaries."""
-from typing import Any
+from typing import Any, Callable, Optional
 
 
 class EventBuffer:
@@ -36,6 +36,38 @@ class EventBuffer:
                 return ev
         return None
 
+    def find_nearest(self, key: str, value: float, tolerance: float,
+                     predicate: Optional[Callable[[dict], bool]] = None):
+        """Return the event whose ``key`` is closest to ``value``.
+
+        Parameters
+        ----------
+        key : str
+            The dictionary key to compare.
+        value : float
+            The value to compare against.
+        tolerance : float
+            The maximum absolute difference for an event to be considered.
+        predicate : callable, optional
+            An additional filter which candidate events must satisfy.
+
+        Returns
+        -------
+        dict | None
+            The closest matching event dictionary, or ``None`` if no event is
+            within the tolerance.
+        """
+        best = None
+        best_diff = tolerance
+        for ev in self._evs:
+            if key not in ev:
+                continue
+            diff = abs(ev[key] - value)
+            if diff <= best_diff and (predicate is None or predicate(ev)):
+                best = ev
+                best_diff = diff
+        return best
+
     def append(self, ev: dict):
         """Add an event to the buffer.
 
@@ -46,10 +78,23 @@ class EventBuffer:
         ----------
         ev : dict
             The event dictionary to append.
+
+        Returns
+        -------
+        dict | None
+            The event which was removed to make room, if any.
         """
         self._evs.append(ev)
         if len(self._evs) > self._keep:
-            del self._evs[0]
+            return self._evs.pop(0)
+        return None
+
+    def remove(self, ev: dict):
+        """Remove the given event (by identity) from the buffer, if present."""
+        for i, candidate in enumerate(self._evs):
+            if candidate is ev:
+                del self._evs[i]
+                return
 
     def evict_older(self, key: str, value: float):
         """Remove events that are older than a given timestamp.
@@ -72,3 +117,28 @@ class EventBuffer:
                 del self._evs[0]
             else:
                 return
+
+    def evict_before(self, key: str, value: float) -> int:
+        """Remove all events whose ``key`` is less than ``value``.
+
+        Unlike :py:meth:`evict_older` the whole buffer is inspected, so events
+        which were inserted out of order are evicted as well.
+
+        Parameters
+        ----------
+        key : str
+            The timestamp key to inspect in each event.
+        value : float
+            The cutoff timestamp; events with timestamps < this value are removed.
+
+        Returns
+        -------
+        int
+            The number of events removed.
+        """
+        before = len(self._evs)
+        self._evs = [ev for ev in self._evs if not (key in ev and ev[key] < value)]
+        return before - len(self._evs)
+
+    def __len__(self):
+        return len(self._evs)
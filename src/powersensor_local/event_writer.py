@@ -0,0 +1,242 @@
+"""Buffered, filtered event output for the commandline utils."""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+from abc import abstractmethod
+from types import SimpleNamespace
+from typing import Any, Iterable, Optional, TextIO
+
+from powersensor_local.abstract_event_handler import AbstractEventHandler, add_loop_argument
+
+FORMATS = ('repr', 'jsonl', 'csv')
+
+# CSV columns for the events documented in xlatemsg.translate_raw_message
+EVENT_FIELDS = [
+    'event', 'mac', 'role', 'via', 'device_type', 'starttime_utc',
+    'duration_s', 'watts', 'apparent_current', 'active_current',
+    'reactive_current', 'volts', 'summation_joules', 'summation_resettime_utc',
+    'litres_per_minute', 'summation_litres', 'value', 'average_rssi',
+    'last_rssi',
+]
+
+# CSV columns for raw plug messages
+RAW_FIELDS = [
+    'event', 'type', 'subtype', 'device', 'mac', 'role', 'starttime',
+    'duration', 'unit', 'power', 'current', 'active_current',
+    'reactive_current', 'voltage', 'summation', 'summation_start',
+    'batteryMicrovolt', 'rssi', 'raw_rssi',
+]
+
+MAX_PENDING = 4096
+
+def add_output_arguments(parser: argparse.ArgumentParser):
+    """Add the output format, filtering and statistics options."""
+    parser.add_argument(
+        '--format', choices=FORMATS, default='repr',
+        help='output format (default: repr)')
+    parser.add_argument(
+        '--events', type=_csv_list,
+        help='comma-separated list of event names to include')
+    parser.add_argument(
+        '--mac', type=_csv_list,
+        help='comma-separated list of device MAC addresses to include')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print per-device event rates instead of the events')
+    parser.add_argument(
+        '--flush-interval', type=float, default=1.0, metavar='SECONDS',
+        help='maximum time output is buffered for (default: 1.0)')
+
+def _csv_list(value: str) -> list:
+    return [item for item in value.split(',') if item]
+
+class EventWriter:
+    """Writes (event_name, event) pairs to a stream in the chosen format.
+
+    Filters are applied before any formatting takes place. Output is
+    collected in memory and written out in one go at most every
+    flush_interval_s seconds (or once MAX_PENDING lines are pending), rather
+    than line by line. In stats mode, only per-device event counts are
+    kept, and their rates are written out every flush interval instead.
+
+    Call start() from within the event loop to enable the periodic flush,
+    and close() to write out anything still pending.
+    """
+
+    # pylint: disable=R0902,R0913,R0917
+    def __init__(self, fmt: str = 'repr', stream: Optional[TextIO] = None,
+                 events: Optional[Iterable[str]] = None,
+                 macs: Optional[Iterable[str]] = None, stats: bool = False,
+                 flush_interval_s: float = 1.0, fields: Iterable[str] = None,
+                 repr_with_name: bool = True):
+        """Constructor.
+        fmt One of 'repr', 'jsonl' or 'csv'.
+        stream The stream to write to, sys.stdout by default.
+        events/macs If given, only events with these names/from these
+          devices are written.
+        fields The CSV columns, EVENT_FIELDS by default.
+        repr_with_name Whether the repr format prefixes the event name.
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f'Unsupported format: {fmt}')
+        self._fmt = fmt
+        self._stream = stream if stream is not None else sys.stdout
+        self._events = None if events is None else frozenset(events)
+        self._macs = None if macs is None else frozenset(macs)
+        self._stats = stats
+        self._interval = flush_interval_s
+        self._repr_with_name = repr_with_name
+        self._pending = []
+        self._counts = {}
+        self._since = time.monotonic()
+        self._task = None
+        self._csv = None
+        if fmt == 'csv' and not stats:
+            # The csv module writes formatted rows straight to the pending list
+            self._csv = csv.DictWriter(
+                SimpleNamespace(write=self._pending.append),
+                fields if fields is not None else EVENT_FIELDS,
+                extrasaction='ignore', lineterminator='\n')
+            self._csv.writeheader()
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace, **kwargs) -> 'EventWriter':
+        """Creates a writer from options added by add_output_arguments()."""
+        return cls(args.format, events=args.events, macs=args.mac,
+                   stats=args.stats, flush_interval_s=args.flush_interval,
+                   **kwargs)
+
+    def start(self):
+        """Starts the periodic flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        """Stops the periodic flush, and writes out anything pending."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+
+    def write(self, name: str, ev: Any = None):
+        """Filters, formats and queues an event for output."""
+        if self._events is not None and name not in self._events:
+            return
+        mac = ev.get('mac') if isinstance(ev, dict) else None
+        if self._macs is not None and mac not in self._macs:
+            return
+        if self._stats:
+            self._counts[mac] = self._counts.get(mac, 0) + 1
+            return
+
+        if self._fmt == 'jsonl':
+            self._pending.append(json.dumps(
+                self._as_record(name, ev), separators=(',', ':'), default=str) + '\n')
+        elif self._fmt == 'csv':
+            self._csv.writerow(self._as_record(name, ev))
+        elif self._repr_with_name:
+            self._pending.append(f'{name} {ev}\n')
+        else:
+            self._pending.append(f'{ev if ev is not None else name}\n')
+
+        if len(self._pending) >= MAX_PENDING:
+            self.flush()
+
+    def flush(self):
+        """Writes out all pending output (or the rates, in stats mode)."""
+        if self._stats:
+            self._write_stats()
+        if self._pending:
+            self._stream.write(''.join(self._pending))
+            self._pending.clear()
+        self._stream.flush()
+
+    @staticmethod
+    def _as_record(name: str, ev: Any) -> dict:
+        if isinstance(ev, dict):
+            if ev.get('event') == name:
+                return ev
+            return { 'event': name, **ev }
+        if ev is None:
+            return { 'event': name }
+        return { 'event': name, 'value': repr(ev) }
+
+    def _write_stats(self):
+        now = time.monotonic()
+        elapsed = max(now - self._since, 1e-9)
+        counts = self._counts
+        self._counts = {}
+        self._since = now
+        total = sum(counts.values())
+        if self._fmt == 'jsonl':
+            for mac, count in sorted(counts.items(), key=lambda kv: -kv[1]):
+                self._pending.append(json.dumps(
+                    { 'mac': mac, 'events_per_s': round(count / elapsed, 2) },
+                    separators=(',', ':')) + '\n')
+            return
+        lines = [f'--- {len(counts)} devices, {total / elapsed:.1f} events/s\n']
+        for mac, count in sorted(counts.items(), key=lambda kv: -kv[1]):
+            lines.append(f'{mac!s:>16} {count / elapsed:10.1f}/s\n')
+        self._pending.extend(lines)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.flush()
+
+
+class PlugEventWriter(AbstractEventHandler):
+    """Base for the commandline utils which write out the events of a single
+    plug, as selected by the options from add_output_arguments().
+
+    Subclasses create the plug in _create_plug() and list the events to
+    subscribe to in _event_names().
+    """
+
+    def __init__(self, args: argparse.Namespace, **writer_kwargs):
+        self.plug = None
+        self._args = args
+        self.writer = EventWriter.from_args(args, **writer_kwargs)
+
+    @classmethod
+    def run_app(cls, parser: argparse.ArgumentParser):
+        """Adds the common options to the parser, parses the commandline and
+        runs the util."""
+        add_loop_argument(parser)
+        add_output_arguments(parser)
+        args = parser.parse_args()
+        cls(args).run(args.loop)
+
+    @abstractmethod
+    def _create_plug(self, args: argparse.Namespace):
+        """Returns the (not yet connected) plug to write the events of."""
+
+    @abstractmethod
+    def _event_names(self, args: argparse.Namespace) -> Iterable[str]:
+        """Returns the names of the events to subscribe to."""
+
+    async def on_exit(self):
+        if self.plug is not None:
+            await self.plug.disconnect()
+            self.plug = None
+        self.writer.close()
+
+    async def on_event(self, event, message=None):
+        """Callback for writing out event data."""
+        self.writer.write(event, message)
+
+    async def main(self):
+        # Signal handler for Ctrl+C
+        self.register_sigint_handler()
+
+        plug = self.plug = self._create_plug(self._args)
+        for ev in self._event_names(self._args):
+            plug.subscribe(ev, self.on_event)
+        self.writer.start()
+        plug.connect()
+
+        # Keep the event loop running until Ctrl+C is pressed
+        await self.wait()
@@ -3,6 +3,7 @@
 """Utility script for accessing the full event stream from all network-local
 Powersensor devices. Intended for debugging use only. Please use the proper
 interface in devices.py rather than parsing the output from this script."""
+import argparse
 import typing
 import sys
 from pathlib import Path
@@ -13,20 +14,23 @@ if PROJECT_ROOT not in sys.path:
 
 # pylint: disable=C0413
 from powersensor_local.devices import PowersensorDevices
-from powersensor_local.abstract_event_handler import AbstractEventHandler
+from powersensor_local.abstract_event_handler import AbstractEventHandler, add_loop_argument
+from powersensor_local.event_writer import EventWriter, add_output_arguments
 
 class EventLoopRunner(AbstractEventHandler):
     """Main logic wrapper."""
-    def __init__(self):
+    def __init__(self, writer: EventWriter):
         self.devices: typing.Union[PowersensorDevices, None] = PowersensorDevices()
+        self.writer = writer
 
     async def on_exit(self):
         if self.devices is not None:
             await self.devices.stop()
+        self.writer.close()
 
     async def on_message(self, obj):
         """Callback for printing received events."""
-        print(obj)
+        self.writer.write(obj['event'], obj)
         if obj['event'] == 'device_found':
             self.devices.subscribe(obj['mac'])
 
@@ -37,6 +41,7 @@ class EventLoopRunner(AbstractEventHandler):
         # Signal handler for Ctrl+C
         self.register_sigint_handler()
 
+        self.writer.start()
         await self.devices.start(self.on_message)
 
         # Keep the event loop running until Ctrl+C is pressed
@@ -44,7 +49,13 @@ class EventLoopRunner(AbstractEventHandler):
 
 def app():
     """Application entry point."""
-    EventLoopRunner().run()
+    parser = argparse.ArgumentParser(
+        description='Show the event stream from all network-local Powersensor devices.')
+    add_loop_argument(parser)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+    writer = EventWriter.from_args(args, repr_with_name=False)
+    EventLoopRunner(writer).run(args.loop)
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,266 @@
+"""Re-publishing of an event stream to many local clients.
+
+Plugs accept only a limited number of subscriptions, so rather than each
+tool subscribing to the plugs directly, a FanoutServer subscribes once and
+passes the translated events on to any number of FanoutClients, over a Unix
+socket or TCP.
+
+The protocol is JSON lines. The server sends each event as
+
+  { "event": "<name>", "data": { ... } }
+
+and clients may at any time send a filter, restricting which events they
+receive (null meaning no restriction):
+
+  { "filter": { "events": [ ... ] | null, "macs": [ ... ] | null } }
+"""
+import asyncio
+import json
+from typing import Iterable, Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter, EventStream
+
+FANOUT_PORT = 49477
+CLIENT_BUFFER = 1000
+
+# Events a FanoutClient emits locally, rather than receiving from the server
+_LOCAL_EVENTS = frozenset(('exception', 'connecting', 'connected', 'disconnected'))
+
+class _Client: # pylint: disable=R0903
+    __slots__ = ('events', 'macs', 'stream', 'writer', 'handler')
+
+    def __init__(self, maxsize, writer):
+        self.events = None
+        self.macs = None
+        self.stream = EventStream(maxsize, 'drop_oldest')
+        self.writer = writer
+        self.handler = asyncio.current_task()
+
+class FanoutServer:
+    """
+    Re-publishes events to any number of connected FanoutClients.
+
+    Events are fed in via publish(), which has the signature of an
+    AsyncEventEmitter handler, so a server may be attached directly to e.g. a
+    PlugApi (see attach()), or via publish_devices_event() as the callback of
+    PowersensorDevices.start().
+
+    Each event is serialised once, however many clients receive it. Every
+    client has its own bounded buffer of client_buffer lines; when a slow
+    client falls behind by more than that, its oldest lines are dropped
+    rather than holding up the other clients. Dropped lines are counted in
+    dropped.
+    """
+
+    def __init__(self, path: Optional[str] = None, host: str = '127.0.0.1',
+                 port: int = FANOUT_PORT, client_buffer: int = CLIENT_BUFFER):
+        """Constructor.
+        path Listen on this Unix socket path, rather than on TCP host:port.
+        client_buffer The number of lines buffered per client.
+        """
+        self._path = path
+        self._host = host
+        self._port = port
+        self._client_buffer = client_buffer
+        self._clients = set()
+        self._server = None
+        self._dropped = 0
+
+    async def start(self):
+        """Starts listening for clients."""
+        if self._path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._on_client, self._path)
+        else:
+            self._server = await asyncio.start_server(
+                self._on_client, self._host, self._port)
+
+    async def close(self):
+        """Stops listening, and disconnects all clients."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        clients = list(self._clients)
+        for client in clients:
+            client.stream.close()
+            client.writer.close()
+        await asyncio.gather(*(c.handler for c in clients), return_exceptions=True)
+
+    @property
+    def sockets(self):
+        """The listening sockets, e.g. for finding the assigned port."""
+        return self._server.sockets if self._server is not None else ()
+
+    @property
+    def client_count(self) -> int:
+        """The number of connected clients."""
+        return len(self._clients)
+
+    @property
+    def dropped(self) -> int:
+        """The number of lines dropped across all clients, including those
+        of clients no longer connected."""
+        return self._dropped + sum(c.stream.lagged for c in self._clients)
+
+    def attach(self, emitter: AsyncEventEmitter, events: Iterable[str]):
+        """Subscribes to the given events on e.g. a PlugApi instance."""
+        for name in events:
+            emitter.subscribe(name, self.publish)
+
+    def detach(self, emitter: AsyncEventEmitter, events: Iterable[str]):
+        """Reverses attach()."""
+        for name in events:
+            emitter.unsubscribe(name, self.publish)
+
+    async def publish(self, event_name: str, ev=None):
+        """Sends an event to all clients whose filters match it."""
+        line = None
+        mac = ev.get('mac') if isinstance(ev, dict) else None
+        for client in self._clients:
+            if client.events is not None and event_name not in client.events:
+                continue
+            if client.macs is not None and mac not in client.macs:
+                continue
+            if line is None:
+                line = json.dumps({ 'event': event_name, 'data': ev },
+                                  separators=(',', ':'), default=str) + '\n'
+            await client.stream.push(event_name, line)
+
+    async def publish_devices_event(self, obj: dict):
+        """Publishes an event as delivered by PowersensorDevices."""
+        await self.publish(obj['event'], obj)
+
+    async def _on_client(self, reader, writer):
+        client = _Client(self._client_buffer, writer)
+        self._clients.add(client)
+        write_task = asyncio.create_task(self._write_client(client, writer))
+        try:
+            while line := await reader.readline():
+                self._apply_filter(client, line)
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(client)
+            self._dropped += client.stream.lagged
+            client.stream.close()
+            await write_task
+
+    @staticmethod
+    def _apply_filter(client, line):
+        try:
+            spec = json.loads(line)['filter']
+            events = spec.get('events')
+            macs = spec.get('macs')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return # Ignore malformed requests
+        client.events = None if events is None else frozenset(events)
+        client.macs = None if macs is None else frozenset(macs)
+
+    @staticmethod
+    async def _write_client(client, writer):
+        try:
+            async for _, line in client.stream:
+                # Coalesce whatever else is queued into the same write
+                lines = [line]
+                lines.extend(item[1] for item in client.stream.drain())
+                writer.write(''.join(lines).encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class FanoutClient(AsyncEventEmitter):
+    """
+    Receives the events re-published by a FanoutServer. Offers the same
+    subscribe() interface as PlugApi; the server is told which events are
+    subscribed to, so that only those are sent.
+
+    Additionally emits 'connecting', 'connected' and 'disconnected' as the
+    connection state changes, and reconnects automatically until
+    disconnect() is called.
+    """
+
+    def __init__(self, path: Optional[str] = None, host: str = '127.0.0.1',
+                 port: int = FANOUT_PORT, macs: Optional[Iterable[str]] = None):
+        """Constructor.
+        path Connect to this Unix socket path, rather than to TCP host:port.
+        macs If given, only events from these devices are received.
+        """
+        super().__init__()
+        self._path = path
+        self._host = host
+        self._port = port
+        self._macs = None if macs is None else sorted(macs)
+        self._writer = None
+        self._task = None
+        self._disconnecting = False
+
+    def connect(self):
+        """Initiates the connection to the server. Will automatically retry on
+        failure or if the connection is lost, until disconnect() is called."""
+        if self._task is not None:
+            raise RuntimeError("already connected/connecting")
+        self._disconnecting = False
+        self._task = asyncio.create_task(self._run())
+
+    async def disconnect(self):
+        """Disconnects from the server, with no further reconnects."""
+        self._disconnecting = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, event_name, callback):
+        super().subscribe(event_name, callback)
+        self._send_filter()
+
+    def unsubscribe(self, event_name, callback):
+        super().unsubscribe(event_name, callback)
+        self._send_filter()
+
+    def _send_filter(self):
+        if self._writer is None:
+            return
+        events = sorted(name for name, cbs in self._listeners.items()
+                        if cbs and name not in _LOCAL_EVENTS)
+        self._writer.write(json.dumps(
+            { 'filter': { 'events': events, 'macs': self._macs } }).encode() + b'\n')
+
+    async def _run(self):
+        backoff = 0
+        while not self._disconnecting:
+            await self.emit('connecting')
+            try:
+                if self._path is not None:
+                    reader, writer = await asyncio.open_unix_connection(self._path)
+                else:
+                    reader, writer = await asyncio.open_connection(self._host, self._port)
+            except OSError:
+                backoff = min(backoff + 1, 8)
+                await asyncio.sleep(min(5 * 60, 2**backoff))
+                continue
+            backoff = 0
+            self._writer = writer
+            self._send_filter()
+            await self.emit('connected')
+            try:
+                while line := await reader.readline():
+                    try:
+                        msg = json.loads(line)
+                        name, ev = msg['event'], msg['data']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    await self.emit(name, ev)
+            except ConnectionError:
+                pass
+            finally:
+                self._writer = None
+                writer.close()
+            await self.emit('disconnected')
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""Utility script for sharing the event stream from all network-local
+Powersensor devices with multiple local consumers, via a FanoutServer.
+Consumers connect with a FanoutClient."""
+import argparse
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = str(Path(__file__).parents[1])
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+# pylint: disable=C0413
+from powersensor_local.devices import PowersensorDevices
+from powersensor_local.abstract_event_handler import AbstractEventHandler, add_loop_argument
+from powersensor_local.fanout import CLIENT_BUFFER, FANOUT_PORT, FanoutServer
+
+class FanoutRunner(AbstractEventHandler):
+    """Main logic wrapper."""
+    def __init__(self, server: FanoutServer):
+        self.devices = PowersensorDevices()
+        self.server = server
+
+    async def on_exit(self):
+        await self.devices.stop()
+        await self.server.close()
+
+    async def on_message(self, obj):
+        """Callback for re-publishing received events."""
+        if obj['event'] == 'device_found':
+            self.devices.subscribe(obj['mac'])
+        await self.server.publish_devices_event(obj)
+
+    async def main(self):
+        # Signal handler for Ctrl+C
+        self.register_sigint_handler()
+
+        await self.server.start()
+        for sock in self.server.sockets:
+            print(f'Listening on {sock.getsockname()}', file=sys.stderr)
+        await self.devices.start(self.on_message)
+
+        # Keep the event loop running until Ctrl+C is pressed
+        await self.wait()
+
+def app():
+    """Application entry point."""
+    parser = argparse.ArgumentParser(
+        description='Share the event stream from all network-local Powersensor '
+                    'devices with multiple local clients.')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='listen on a Unix socket, rather than on TCP')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='TCP address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=FANOUT_PORT,
+                        help=f'TCP port to listen on (default: {FANOUT_PORT})')
+    parser.add_argument('--buffer', type=int, default=CLIENT_BUFFER,
+                        help='events buffered per client before the oldest are '
+                             f'dropped (default: {CLIENT_BUFFER})')
+    add_loop_argument(parser)
+    args = parser.parse_args()
+    server = FanoutServer(args.socket, args.host, args.port, args.buffer)
+    FanoutRunner(server).run(args.loop)
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,155 @@
+"""Routing of device events to many VirtualHousehold instances."""
+from typing import Any, Callable, Hashable, Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter, EventProcessorMixin
+from powersensor_local.virtual_household import VirtualHousehold
+
+HOUSEHOLD_EVENTS = [
+    'household_power',
+    'household_summation',
+]
+
+# pylint: disable=R0902
+class HouseholdManager(EventProcessorMixin, AsyncEventEmitter):
+    """
+    Manages a VirtualHousehold per site, and routes device events to them.
+
+    Devices are assigned to a household either by their own MAC address, or
+    by the MAC address of the plug relaying for them. Routing is a pair of
+    dictionary lookups per event, regardless of the number of households.
+
+    The manager may be subscribed directly to one or more PlugApi instances
+    (see attach()), or fed via process_event().
+
+    The following events are emitted:
+
+    * household_event: For every combined record produced by a household,
+      with the payload { household_id: , event: , data: { ... } } where
+      'event' is the VirtualHousehold event name ('household_power' or
+      'household_summation') and 'data' its payload.
+    * household_batch: Only when batching is enabled. The payload is a list
+      of household_event payloads, in the order they were produced.
+    """
+
+    def __init__(self, batch_size: int = 0,
+                 instants_keep: int = 31, summations_keep: int = 5):
+        """Constructor.
+        batch_size When non-zero, household outputs are collected and emitted
+          as a single 'household_batch' event once this many have been
+          collected, or when flush() is called.
+        instants_keep/summations_keep The number of average_power and
+          summation_energy events buffered per role for each household. These
+          bound the memory used per site.
+        """
+        super().__init__()
+        self._batch_size = batch_size
+        self._batch = []
+        self._instants_keep = instants_keep
+        self._summations_keep = summations_keep
+        self._households = {}
+        self._forwarders = {}
+        self._by_mac = {}
+        self._by_relay = {}
+        self._processors = {
+            'average_power': VirtualHousehold.process_average_power_event,
+            'summation_energy': VirtualHousehold.process_summation_event,
+        }
+
+    def add_household(self, household_id: Hashable,
+                      with_solar: bool = False) -> VirtualHousehold:
+        """Creates (or returns the existing) household for the given id."""
+        household = self._households.get(household_id)
+        if household is not None:
+            return household
+        household = VirtualHousehold(
+            with_solar,
+            instants_keep = self._instants_keep,
+            summations_keep = self._summations_keep)
+        forwarder = self._make_forwarder(household_id)
+        for name in HOUSEHOLD_EVENTS:
+            household.subscribe(name, forwarder)
+        self._households[household_id] = household
+        self._forwarders[household_id] = forwarder
+        return household
+
+    def remove_household(self, household_id: Hashable):
+        """Removes a household, along with all device/relay assignments to it."""
+        household = self._households.pop(household_id, None)
+        if household is None:
+            return
+        forwarder = self._forwarders.pop(household_id)
+        for name in HOUSEHOLD_EVENTS:
+            household.unsubscribe(name, forwarder)
+        for table in (self._by_mac, self._by_relay):
+            for mac in [m for m, hid in table.items() if hid == household_id]:
+                del table[mac]
+
+    def household(self, household_id: Hashable) -> Optional[VirtualHousehold]:
+        """Returns the household with the given id, if any."""
+        return self._households.get(household_id)
+
+    def assign_device(self, mac: str, household_id: Hashable):
+        """Routes events originating from the given device MAC address to the
+        given household. The household is created if necessary."""
+        self.add_household(household_id)
+        self._by_mac[mac] = household_id
+
+    def assign_relay(self, plug_mac: str, household_id: Hashable):
+        """Routes all events relayed via the given plug to the given household,
+        unless the originating device has its own assignment. The household is
+        created if necessary."""
+        self.add_household(household_id)
+        self._by_relay[plug_mac] = household_id
+
+    def unassign_device(self, mac: str):
+        """Removes a device assignment made by assign_device()."""
+        self._by_mac.pop(mac, None)
+
+    def unassign_relay(self, plug_mac: str):
+        """Removes a relay assignment made by assign_relay()."""
+        self._by_relay.pop(plug_mac, None)
+
+    def household_for(self, ev: dict) -> Optional[Hashable]:
+        """Returns the id of the household the given event routes to, if any."""
+        hid = self._by_mac.get(ev.get('mac'))
+        if hid is None:
+            hid = self._by_relay.get(ev.get('via'))
+        return hid
+
+    async def process_event(self, event_name: str, ev: dict):
+        """Routes an 'average_power' or 'summation_energy' event to the
+        household it belongs to. Other events, and events from unassigned
+        devices, are ignored."""
+        processor = self._processors.get(event_name)
+        if processor is None:
+            return
+        hid = self.household_for(ev)
+        if hid is None:
+            return
+        await processor(self._households[hid], ev)
+
+    async def flush(self):
+        """Emits any pending batched household outputs."""
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        await self.emit('household_batch', batch)
+
+    def _make_forwarder(self, household_id: Hashable) -> Callable:
+        async def forward(event_name: str, data: Any):
+            out = {
+                'household_id': household_id,
+                'event': event_name,
+                'data': data,
+            }
+            if self._batch_size > 0:
+                self._batch.append(out)
+                if len(self._batch) >= self._batch_size:
+                    await self.flush()
+            else:
+                await self.emit('household_event', out)
+        return forward
+
+    def __len__(self):
+        return len(self._households)
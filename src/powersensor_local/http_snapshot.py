@@ -0,0 +1,272 @@
+"""Serving of the current device and household state over HTTP.
+
+Endpoints:
+
+  GET /state
+    The current state as JSON:
+
+      { "version": "...",
+        "devices": { "<mac>": { ...DeviceState fields... }, ... },
+        "household": { "power": { ... } | null,
+                       "summation": { ... } | null } | null }
+
+    The ETag is the version; a request with a matching If-None-Match gets a
+    304. Adding ?wait=N (seconds) to such a request turns it into a long
+    poll, which only returns once the state has changed or N seconds have
+    passed.
+
+    Versions start with a random epoch chosen by each server instance, so
+    an ETag or event id from before a restart never matches afterwards.
+
+  GET /events
+    A server-sent event stream, with a 'state' event carrying the above
+    JSON each time the state changes.
+"""
+import asyncio
+import json
+import secrets
+from typing import Optional, Union
+from urllib.parse import parse_qs
+
+from powersensor_local.devices import PowersensorDevices
+from powersensor_local.household_manager import HOUSEHOLD_EVENTS
+from powersensor_local.state_store import DeviceStateStore
+from powersensor_local.virtual_household import VirtualHousehold
+
+HTTP_PORT = 49478
+MAX_WAIT_S = 60
+POLL_S = 0.25
+KEEPALIVE_S = 15
+
+_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+}
+
+# pylint: disable=R0902
+class SnapshotServer:
+    """
+    A minimal HTTP server for dashboards polling the current state of all
+    devices (from a DeviceStateStore) and, optionally, a VirtualHousehold.
+
+    The JSON body is built at most once per state version, however many
+    clients fetch it. Clients waiting for changes (long polls and event
+    streams) are woken when the household changes, or when a change of the
+    store version is noticed; the store is checked every POLL_S seconds
+    while anyone is waiting.
+
+      devices = PowersensorDevices(state_store=DeviceStateStore())
+      server = SnapshotServer(devices, household)
+      await server.start()
+    """
+
+    def __init__(self, source: Union[DeviceStateStore, PowersensorDevices],
+                 household: Optional[VirtualHousehold] = None,
+                 host: str = '127.0.0.1', port: int = HTTP_PORT):
+        """Constructor.
+        source A DeviceStateStore, or a PowersensorDevices instance which
+          was given one.
+        household If given, its household_power and household_summation
+          events are included in the state.
+        """
+        store = source if isinstance(source, DeviceStateStore) else source.state_store
+        if store is None:
+            raise ValueError('PowersensorDevices instance has no state_store')
+        self._store = store
+        self._household = household
+        self._host = host
+        self._port = port
+        self._server = None
+        self._household_state = { 'power': None, 'summation': None }
+        self._household_version = 0
+        self._epoch = secrets.token_hex(4) # as versions restart from 0
+        self._version = None
+        self._body = b''
+        self._changed = asyncio.Event()
+        self._waiters = 0
+        self._watch_task = None
+        self._clients = {} # handler task -> writer
+        self.builds = 0
+
+    async def start(self):
+        """Starts listening for clients."""
+        if self._household is not None:
+            for name in HOUSEHOLD_EVENTS:
+                self._household.subscribe(name, self._on_household_event)
+        self._server = await asyncio.start_server(
+            self._on_client, self._host, self._port)
+
+    async def close(self):
+        """Stops listening, and disconnects all clients."""
+        if self._household is not None:
+            for name in HOUSEHOLD_EVENTS:
+                self._household.unsubscribe(name, self._on_household_event)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self._notify()
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        for writer in self._clients.values():
+            writer.close()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+
+    @property
+    def sockets(self):
+        """The listening sockets, e.g. for finding the assigned port."""
+        return self._server.sockets if self._server is not None else ()
+
+    def current(self):
+        """Returns the current (version, JSON body) pair, rebuilding the body
+        only if the state has changed since it was last built."""
+        version = self._current_version()
+        if version != self._version:
+            self._body = json.dumps({
+                'version': version,
+                'devices': dict(self._store.snapshot()),
+                'household': self._household_state if self._household is not None else None,
+            }, separators=(',', ':'), default=str).encode('utf-8')
+            self._version = version
+            self.builds += 1
+        return self._version, self._body
+
+    def _current_version(self) -> str:
+        return f'{self._epoch}.{self._store.version}.{self._household_version}'
+
+    async def _on_household_event(self, event_name: str, ev: dict):
+        key = 'power' if event_name == 'household_power' else 'summation'
+        self._household_state = dict(self._household_state, **{key: ev})
+        self._household_version += 1
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _watch(self):
+        version = self._store.version
+        while self._waiters:
+            await asyncio.sleep(POLL_S)
+            if self._store.version != version:
+                version = self._store.version
+                self._notify()
+        self._watch_task = None
+
+    async def _wait_change(self, version: str, timeout: float):
+        """Waits until the state version differs from the given one, or the
+        timeout expires."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._waiters += 1
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+        try:
+            while self._current_version() == version and self._server is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return
+        finally:
+            self._waiters -= 1
+
+    async def _on_client(self, reader, writer):
+        self._clients[asyncio.current_task()] = writer
+        try:
+            while self._server is not None:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                if not await self._handle(head, writer):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            del self._clients[asyncio.current_task()]
+            writer.close()
+
+    async def _handle(self, head: bytes, writer) -> bool: # pylint: disable=R0914
+        """Handles a request, returning whether to keep the connection open."""
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self._respond(writer, 400, False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        keep_alive = (version == 'HTTP/1.1'
+                      and headers.get('connection', '').lower() != 'close'
+                      and headers.get('content-length', '0') == '0'
+                      and 'transfer-encoding' not in headers)
+        path, _, query = target.partition('?')
+
+        if path == '/events' and method == 'GET':
+            await self._serve_events(writer, headers.get('last-event-id'))
+            return False
+        if path not in ('/state', '/events'):
+            await self._respond(writer, 404, keep_alive)
+            return keep_alive
+        if method not in ('GET', 'HEAD'):
+            await self._respond(writer, 405, keep_alive,
+                                extra=[('Allow', 'GET' if path == '/events' else 'GET, HEAD')])
+            return keep_alive
+
+        try:
+            wait = min(float(parse_qs(query).get('wait', ['0'])[0]), MAX_WAIT_S)
+        except ValueError:
+            await self._respond(writer, 400, keep_alive)
+            return keep_alive
+        tags = {t.strip() for t in headers.get('if-none-match', '').split(',')}
+        state_version, body = self.current()
+        if wait > 0 and f'"{state_version}"' in tags:
+            await self._wait_change(state_version, wait)
+            state_version, body = self.current()
+        etag = f'"{state_version}"'
+        if etag in tags or '*' in tags:
+            await self._respond(writer, 304, keep_alive, extra=[('ETag', etag)])
+        else:
+            await self._respond(writer, 200, keep_alive, body, method == 'HEAD',
+                                [('ETag', etag), ('Content-Type', 'application/json')])
+        return keep_alive
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive, body=b'', # pylint: disable=R0913,R0917
+                       head_only=False, extra=()):
+        lines = [f'HTTP/1.1 {status} {_REASONS[status]}',
+                 'Cache-Control: no-cache',
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        if status != 304:
+            lines.append(f'Content-Length: {len(body)}')
+        lines.extend(f'{name}: {value}' for name, value in extra)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body and not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def _serve_events(self, writer, last_id: Optional[str]):
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: close\r\n\r\n'
+                     b'retry: 5000\n\n')
+        while self._server is not None:
+            state_version, body = self.current()
+            if state_version != last_id:
+                writer.write(b'id: %s\nevent: state\ndata: %s\n\n'
+                             % (state_version.encode(), body))
+                last_id = state_version
+            else:
+                writer.write(b': keepalive\n\n')
+            await writer.drain()
+            await self._wait_change(state_version, KEEPALIVE_S)
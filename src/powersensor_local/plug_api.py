@@ -1,16 +1,31 @@
 """Interface abstraction for Powersensor plugs."""
-import sys
-from pathlib import Path
-PROJECT_ROOT = str(Path(__file__).parents[1])
-if PROJECT_ROOT not in sys.path:
-    sys.path.append(PROJECT_ROOT)
+import time
+from collections import OrderedDict
 
-# pylint: disable=C0413
 from powersensor_local.async_event_emitter import AsyncEventEmitter
 from powersensor_local.plug_listener_tcp import PlugListenerTcp
 from powersensor_local.plug_listener_udp import PlugListenerUdp
+from powersensor_local.tracing import current_trace
 from powersensor_local.xlatemsg import translate_raw_message
 
+RELAY_EXPIRY_S = 5 * 60
+MAX_RELAYED = 256
+
+# All data events which a PlugApi may emit
+PLUG_EVENTS = (
+    'average_flow',
+    'average_power',
+    'average_power_components',
+    'battery_level',
+    'no_longer_relaying_for',
+    'now_relaying_for',
+    'radio_signal_quality',
+    'summation_energy',
+    'summation_volume',
+    'uncalibrated_average_reading',
+)
+
+# pylint: disable=R0902
 class PlugApi(AsyncEventEmitter):
     """
     The primary interface to access the interpreted event stream from a plug.
@@ -19,10 +34,34 @@ class PlugApi(AsyncEventEmitter):
     to its own reports.
 
     Acts as an AsyncEventEmitter. Events which can be registered for are
-    documented in xlatemsg.translate_raw_message.
+    documented in xlatemsg.translate_raw_message. Additionally, the following
+    events are synthesized:
+
+    now_relaying_for:
+        The plug has started relaying for a sensor, either for the first
+        time or after having previously stopped doing so.
+
+        { mac: "...", device_type: "...", role: "..." }
+
+    no_longer_relaying_for:
+        The plug has not relayed anything for the sensor in the relay expiry
+        time (e.g. because the sensor is now relayed by another plug), or
+        the sensor was displaced by more recently seen sensors, or the plug
+        was disconnected.
+
+        { mac: "...", via: "..." }
+
+    The number of times the connection to the plug has been re-established,
+    and the number of messages which could not be decoded or interpreted,
+    are kept in the reconnects and malformed attributes.
+
+    Latencies are traced while a tracing.LatencyTracer is attached.
     """
 
-    def __init__(self, mac, ip, port=49476, proto='udp'):
+    # pylint: disable=R0913,R0917
+    def __init__(self, mac, ip, port=49476, proto='udp',
+                 relay_expiry_s=RELAY_EXPIRY_S, max_relayed=MAX_RELAYED,
+                 rcvbuf=None, drain=False):
         """Create a :class:`PlugApi` instance for a single plug.
 
         Parameters
@@ -37,6 +76,17 @@ class PlugApi(AsyncEventEmitter):
             Protocol used for communication.  ``'udp'`` selects :class:`PlugListenerUdp`,
             while ``'tcp'`` selects :class:`PlugListenerTcp`.  Any other value raises a
             :class:`ValueError`.
+        relay_expiry_s : float, optional
+            Seconds without a message from a sensor after which the plug is
+            considered to no longer be relaying for it.
+        max_relayed : int, optional
+            The maximum number of sensors tracked as being relayed for. When
+            exceeded, the least recently seen sensor is dropped.
+        rcvbuf : int, optional
+            UDP only. The socket receive buffer size; see :class:`PlugListenerUdp`.
+        drain : bool, optional
+            UDP only. Whether to read all ready datagrams per wakeup; see
+            :class:`PlugListenerUdp`.
 
         Raises
         ------
@@ -46,14 +96,22 @@ class PlugApi(AsyncEventEmitter):
         super().__init__()
         self._mac = mac
         if proto == 'udp':
-            self._listener = PlugListenerUdp(ip, port)
+            self._listener = PlugListenerUdp(ip, port, rcvbuf, drain)
         elif proto == 'tcp':
             self._listener = PlugListenerTcp(ip, port)
         else:
             raise ValueError(f'Unsupported proto: {proto}')
         self._listener.subscribe('message', self._on_message)
         self._listener.subscribe('exception', self._on_exception)
-        self._seen = set()
+        self._listener.subscribe('connected', self._on_connected)
+        self._listener.subscribe('malformed', self._on_malformed)
+        self._relay_expiry_s = relay_expiry_s
+        self._max_relayed = max_relayed
+        self._relaying = OrderedDict() # mac -> last seen, oldest first
+        self._connects = 0
+        self.reconnects = 0
+        self.malformed = 0
+        self._tracer = None
 
     def connect(self):
         """
@@ -67,36 +125,110 @@ class PlugApi(AsyncEventEmitter):
     async def disconnect(self):
         """Disconnects from the plug and stops further connection attempts."""
         await self._listener.disconnect()
+        relaying = list(self._relaying)
+        self._relaying.clear()
+        for mac in relaying:
+            await self.emit('no_longer_relaying_for', {
+                'mac': mac,
+                'via': self._mac,
+            })
+
+    @property
+    def relaying_for(self):
+        """A live view of the MAC addresses of the sensors this plug is
+        currently relaying for, supporting O(1) membership tests."""
+        return self._relaying.keys()
 
     async def _on_message(self, _, message):
         """Translates the raw message and emits the resulting messages, if any.
 
-        Also synthesizes 'now_relaying_for' messages as needed.
+        Also synthesizes 'now_relaying_for' and 'no_longer_relaying_for'
+        messages as needed.
         """
         try:
             evs = translate_raw_message(message, self._mac)
         except KeyError:
             # Ignore malformed messages
+            self.malformed += 1
             return
-
+        trace = current_trace.get() if self._tracer is not None else None
+        if trace is not None:
+            trace.translated = time.perf_counter()
+            for ev in evs.values():
+                self._tracer.on_translated(trace, ev)
+
+        now = time.monotonic()
+        relaying = self._relaying
         msgmac = message.get('mac')
-        if msgmac != self._mac and msgmac not in self._seen:
-            self._seen.add(msgmac)
-            # We want to emit this prior to events with data
-            ev = {
-                'mac': msgmac,
-                'device_type': message.get('device'),
-                'role': message.get('role'),
-            }
-            await self.emit('now_relaying_for', ev)
+        if msgmac is not None and msgmac != self._mac:
+            known = msgmac in relaying
+            relaying[msgmac] = now
+            if known:
+                relaying.move_to_end(msgmac)
+            else:
+                # We want to emit this prior to events with data
+                ev = {
+                    'mac': msgmac,
+                    'device_type': message.get('device'),
+                    'role': message.get('role'),
+                }
+                await self.emit('now_relaying_for', ev)
+        await self._expire_relays(now)
 
         for name, ev in evs.items():
+            if trace is not None:
+                trace.event = ev
             await self.emit(name, ev)
 
+    async def _expire_relays(self, now):
+        """Drops sensors not seen within the relay expiry time, or in excess
+        of the maximum tracked. Only the oldest entries need inspecting."""
+        relaying = self._relaying
+        cutoff = now - self._relay_expiry_s
+        while relaying:
+            mac, seen = next(iter(relaying.items()))
+            if seen >= cutoff and len(relaying) <= self._max_relayed:
+                return
+            del relaying[mac]
+            await self.emit('no_longer_relaying_for', {
+                'mac': mac,
+                'via': self._mac,
+            })
+
+    async def _on_connected(self, _):
+        self._connects += 1
+        if self._connects > 1:
+            self.reconnects += 1
+
+    async def _on_malformed(self, *_):
+        self.malformed += 1
+
     async def _on_exception(self, _, e):
         """Propagates exceptions from the plug listener."""
         await self.emit('exception', e)
 
+    @property
+    def tracer(self):
+        """The tracing.LatencyTracer in use, if any. Set via its attach()."""
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer
+        self._listener.tracer = tracer
+
+    @property
+    def listener(self):
+        """The underlying PlugListenerUdp/PlugListenerTcp, e.g. for replacing
+        its pipeline stages or inspecting their stats."""
+        return self._listener
+
+    @property
+    def kernel_drops(self):
+        """The number of datagrams dropped by the kernel, as reported by
+        PlugListenerUdp.kernel_drops. Always None when using TCP."""
+        return getattr(self._listener, 'kernel_drops', None)
+
     @property
     def ip_address(self):
         """
@@ -0,0 +1,203 @@
+"""Common base for the transport specific plug listeners."""
+import json
+import time
+from abc import ABC, abstractmethod
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter
+from powersensor_local.tracing import current_trace
+
+# The pipeline stages, in order
+STAGES = ('framing', 'prefilter', 'decode', 'control', 'dispatch')
+
+def not_blank(line: bytes) -> bool:
+    """The default prefilter stage, which passes all non-blank lines."""
+    return bool(line) and not line.isspace()
+
+def _no_clock():
+    return 0.0
+
+class StageStats: # pylint: disable=R0903
+    """Counters for a pipeline stage. Seconds are only accumulated while
+    timing is enabled on the listener."""
+    __slots__ = ('items_in', 'items_out', 'seconds')
+
+    def __init__(self):
+        self.items_in = 0
+        self.items_out = 0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        """Returns the counters as a dict."""
+        return {
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'seconds': self.seconds,
+        }
+
+# pylint: disable=R0902
+class PlugListener(AsyncEventEmitter, ABC):
+    """Base class for accessing the event stream from a single plug. The
+    subclasses provide the transport and connection management, while the
+    received data is processed here, by a pipeline of stages:
+
+      framing(data) -> list of lines
+        Splits received data into lines. Default: bytes.splitlines
+      prefilter(line) -> bool
+        Cheaply discards lines before decoding. Default: not_blank
+      decode(line) -> dict
+        Decodes a line into a message, raising ValueError (e.g. a
+        JSONDecodeError) if it can't. Such lines, as well as lines which
+        don't decode to a dict, are emitted as 'malformed'. Default: json.loads
+      control(message) -> bool
+        Handles control messages (subscription warnings, discovery), and
+        returns True for those to not dispatch them. Default: handle_control
+      dispatch(messages, malformed)
+        Async; emits the resulting events. Default: dispatch_events
+
+    Each stage is an attribute which may be replaced, e.g. to use a faster
+    JSON decoder:
+
+      listener.decode = orjson.loads
+
+    Per stage counters are kept in the stats dict, see stage_stats(). Setting
+    timing to True also accumulates the time spent in each stage, at the
+    cost of a few clock reads per received packet/line.
+
+    When a tracing.LatencyTracer is set as tracer (see PlugApi), received
+    data is stamped on receipt and after decoding, and the trace is made
+    available to the dispatch stage via tracing.current_trace.
+    """
+
+    def __init__(self, ip, port=49476):
+        super().__init__()
+        self._ip = ip
+        self._port = port
+        self.framing = bytes.splitlines
+        self.prefilter = not_blank
+        self.decode = json.loads
+        self.control = self.handle_control
+        self.dispatch = self.dispatch_events
+        self.stats = { stage: StageStats() for stage in STAGES }
+        self._clock = _no_clock
+        self.tracer = None
+
+    @property
+    def timing(self) -> bool:
+        """Whether time spent is accumulated in the stage stats."""
+        return self._clock is not _no_clock
+
+    @timing.setter
+    def timing(self, enabled: bool):
+        self._clock = time.perf_counter if enabled else _no_clock
+
+    def stage_stats(self) -> dict:
+        """Returns the per stage counters, as a dict of dicts."""
+        return { stage: stats.as_dict() for stage, stats in self.stats.items() }
+
+    def reset_stats(self):
+        """Zeroes the per stage counters."""
+        self.stats = { stage: StageStats() for stage in STAGES }
+
+    def handle_control(self, message: dict) -> bool:
+        """The default control stage. Renews the subscription when the plug
+        warns that it's about to expire, and drops discovery responses."""
+        typ = message.get('type')
+        if typ == 'subscription':
+            if message.get('subtype') == 'warning':
+                self._send_subscribe()
+            return True
+        return typ == 'discovery'
+
+    async def dispatch_events(self, messages: list, malformed: list):
+        """The default dispatch stage. Emits 'malformed' for each line which
+        failed to decode, and 'message' for each message."""
+        for line in malformed:
+            await self.emit('malformed', line)
+        for message in messages:
+            await self.emit('message', message)
+
+    @abstractmethod
+    def _send_subscribe(self):
+        """Sends a (renewed) subscription request to the plug, if connected."""
+
+    def _start_trace(self):
+        """Returns a new trace stamped with the receive time, if tracing."""
+        tracer = self.tracer
+        return tracer.start() if tracer is not None else None
+
+    def _process(self, data: bytes, trace=None): # pylint: disable=R0914
+        """Runs received data through the stages up to (not including)
+        dispatch, returning the lists of messages and malformed lines."""
+        clock = self._clock
+        stats = self.stats
+        t0 = clock()
+        lines = self.framing(data)
+        t1 = clock()
+        st = stats['framing']
+        st.items_in += 1
+        st.items_out += len(lines)
+        st.seconds += t1 - t0
+
+        prefilter = self.prefilter
+        passed = [line for line in lines if prefilter(line)]
+        t2 = clock()
+        st = stats['prefilter']
+        st.items_in += len(lines)
+        st.items_out += len(passed)
+        st.seconds += t2 - t1
+
+        decode = self.decode
+        messages = []
+        malformed = []
+        for line in passed:
+            try:
+                message = decode(line)
+            except ValueError:
+                malformed.append(line)
+                continue
+            if isinstance(message, dict):
+                messages.append(message)
+            else:
+                malformed.append(line)
+        t3 = clock()
+        if trace is not None:
+            trace.decoded = time.perf_counter()
+        st = stats['decode']
+        st.items_in += len(passed)
+        st.items_out += len(messages)
+        st.seconds += t3 - t2
+
+        control = self.control
+        dispatched = [message for message in messages if not control(message)]
+        st = stats['control']
+        st.items_in += len(messages)
+        st.items_out += len(dispatched)
+        st.seconds += clock() - t3
+        return dispatched, malformed
+
+    async def _dispatch(self, messages: list, malformed: list, trace=None):
+        """Runs the dispatch stage."""
+        clock = self._clock
+        t0 = clock()
+        if trace is None:
+            await self.dispatch(messages, malformed)
+        else:
+            token = current_trace.set(trace)
+            try:
+                await self.dispatch(messages, malformed)
+            finally:
+                current_trace.reset(token)
+        st = self.stats['dispatch']
+        st.items_in += len(messages) + len(malformed)
+        st.items_out += len(messages)
+        st.seconds += clock() - t0
+
+    @property
+    def port(self):
+        """Return the port this listener is bound to."""
+        return self._port
+
+    @property
+    def ip(self):
+        """Return the IP address this listener is bound to."""
+        return self._ip
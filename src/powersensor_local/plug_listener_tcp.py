@@ -1,17 +1,9 @@
 """An interface for accessing the event stream from a Powersensor plug."""
 import asyncio
-import json
 
-import sys
-from pathlib import Path
-PROJECT_ROOT = str(Path(__file__).parents[1])
-if PROJECT_ROOT not in sys.path:
-    sys.path.append(PROJECT_ROOT)
+from powersensor_local.plug_listener import PlugListener
 
-# pylint: disable=C0413
-from powersensor_local.async_event_emitter import AsyncEventEmitter
-
-class PlugListenerTcp(AsyncEventEmitter):
+class PlugListenerTcp(PlugListener):
     """An interface class for accessing the event stream from a single plug.
     The following events may be emitted:
       - ("connecting")   Whenever a connection attempt is made.
@@ -24,6 +16,8 @@ class PlugListenerTcp(AsyncEventEmitter):
       is included (as a byte string).
 
       The event handlers must be async.
+
+    Received lines are processed by the pipeline described in PlugListener.
     """
 
     def __init__(self, ip, port=49476):
@@ -37,9 +31,7 @@ class PlugListenerTcp(AsyncEventEmitter):
         port : int, optional
             TCP port used by the plug (default ``49476``).
         """
-        super().__init__()
-        self._ip = ip
-        self._port = port
+        super().__init__(ip, port)
         self._task = None
         self._connection = None
         self._disconnecting = False
@@ -87,13 +79,14 @@ class PlugListenerTcp(AsyncEventEmitter):
             reader, writer = await asyncio.open_connection(self._ip, self._port)
             self._connection = (reader, writer)
 
-            await self._send_subscribe(writer)
+            self._send_subscribe()
+            await writer.drain()
             backoff = 1
 
             await self.emit('connected')
 
             while not self._disconnecting:
-                await self._process_line(reader, writer)
+                await self._process_line(reader)
 
         except (ConnectionResetError, asyncio.TimeoutError):
             # Handle disconnection and retry with exponential backoff
@@ -103,35 +96,15 @@ class PlugListenerTcp(AsyncEventEmitter):
             await asyncio.sleep(min(5 * 60, 2**backoff * 1))
             return await self._do_connection(backoff)
 
-    async def _process_line(self, reader, writer):
+    async def _process_line(self, reader):
         data = await reader.readline()
         if data == b'':
             raise ConnectionResetError
-        if data != b'\n': # Silently ignore empty lines
-            try:
-                message = json.loads(data.decode('utf-8'))
-                typ = message['type']
-                if typ == 'subscription':
-                    if message['subtype'] == 'warning':
-                        await self._send_subscribe(writer)
-                elif typ == 'discovery':
-                    pass
-                else:
-                    await self.emit('message', message)
-            except json.decoder.JSONDecodeError:
-                await self.emit('malformed', data)
-
-    @staticmethod
-    async def _send_subscribe(writer):
-        writer.write(b'subscribe(60)\n')
-        await writer.drain()
-
-    @property
-    def port(self):
-        """Return the TCP port this listener is bound to."""
-        return self._port
-
-    @property
-    def ip(self):
-        """Return the IP address this listener is bound to."""
-        return self._ip
+        trace = self._start_trace()
+        messages, malformed = self._process(data, trace)
+        if messages or malformed:
+            await self._dispatch(messages, malformed, trace)
+
+    def _send_subscribe(self):
+        if self._connection is not None:
+            self._connection[1].write(b'subscribe(60)\n')
@@ -1,20 +1,24 @@
 """An interface for accessing the event stream from a Powersensor plug."""
 import asyncio
-import json
+import os
 import socket
+import struct
 import sys
+import time
 
-from pathlib import Path
-PROJECT_ROOT = str(Path(__file__).parents[1])
-if PROJECT_ROOT not in sys.path:
-    sys.path.append(PROJECT_ROOT)
+from powersensor_local.plug_listener import PlugListener
+from powersensor_local.watchdog import Watchdog
 
-# pylint: disable=C0413
-from powersensor_local.async_event_emitter import AsyncEventEmitter
+# Linux only, and not exposed by the socket module; elsewhere drain mode
+# falls back to /proc/net/udp (if present) for the drop count
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL',
+                      40 if sys.platform.startswith('linux') else None)
+MAX_DATAGRAM = 65535
+MAX_DRAIN = 256 # datagrams read per wakeup, to remain fair to other sockets
+INACTIVITY_S = 60
 
 # pylint: disable=R0902
-# @todo: dream up a base class for PlugListener that TCP/UDP subclass
-class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
+class PlugListenerUdp(PlugListener, asyncio.DatagramProtocol):
     """An interface class for accessing the event stream from a single plug.
     The following events may be emitted:
       - ("connecting")   Whenever a connection attempt is made.
@@ -25,11 +29,18 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
       argument to the registered event handler(s).
       - ("malformed",line) If JSON decoding of a message fails. The raw line
       is included (as a byte string).
+      - ("kernel_drops",count) Only in drain mode, where supported. When the
+      kernel reports having dropped datagrams on the socket, e.g. due to the
+      receive buffer overflowing. The count is the number of newly dropped
+      datagrams.
 
       The event handlers must be async.
+
+    Received datagrams are processed by the pipeline described in
+    PlugListener, with the messages from each datagram dispatched together.
     """
 
-    def __init__(self, ip, port=49476):
+    def __init__(self, ip, port=49476, rcvbuf=None, drain=False):
         """
         Create a :class:`PlugListenerUdp` bound to the given IP address.
 
@@ -39,14 +50,26 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
             The IPv4 or IPv6 address of the plug to listen to.
         port : int, optional
             UDP port used by the plug (default ``49476``).
+        rcvbuf : int, optional
+            Socket receive buffer size in bytes (``SO_RCVBUF``). The kernel
+            default is used if not given. Note that the kernel may cap this
+            (see ``net.core.rmem_max`` on Linux).
+        drain : bool, optional
+            Read all datagrams ready on the socket on each wakeup, rather than
+            one per event loop iteration, to keep up with bursts. On Linux this
+            also enables the reporting of kernel drops via ``SO_RXQ_OVFL``.
+            Requires an event loop supporting ``add_reader()`` and a platform
+            with ``recvmsg()``, i.e. not Windows.
         """
-        super().__init__()
-        self._ip = ip
-        self._port = port
+        super().__init__(ip, port)
+        self._rcvbuf = rcvbuf
+        self._drain = drain
+        self._kernel_drops = 0          # drops on previous sockets
         self._backoff = 0               # exponential backoff
         self._transport = None          # UDP transport/socket
-        self._reconnect = None          # reconnect timer
-        self._inactive = None           # inactivity timer
+        self._reconnect_at = None       # reconnect deadline, while connecting
+        self._last_seen = None          # time of last datagram, once connected
+        self._watchdog = None           # shared timer driving the above
         self._disconnecting = False     # disconnecting flag
         self._was_connected = False     # 'disconnected' event armed?
 
@@ -56,6 +79,9 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
         a time disconnect() is called."""
         self._disconnecting = False
         self._backoff = 0
+        if self._watchdog is None:
+            self._watchdog = Watchdog.for_running_loop()
+            self._watchdog.register(self)
         if self._transport is None:
             asyncio.create_task(self._do_connection())
 
@@ -63,21 +89,26 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
         """Goes through the disconnection process towards a plug. No further
         automatic reconnects will take place, until connect() is called."""
         self._disconnecting = True
+        if self._watchdog is not None:
+            self._watchdog.unregister(self)
+            self._watchdog = None
 
         await self._close_connection()
 
     async def _close_connection(self, unsub = True):
-        if self._reconnect is not None:
-            self._reconnect.cancel()
-            self._reconnect = None
-
-        if self._inactive is not None:
-            self._inactive.cancel()
-            self._inactive = None
+        # If this happens while still waiting for the plug to respond (e.g.
+        # on an ICMP port unreachable), the pending retry honours the backoff
+        # rather than reconnecting straight away.
+        retry_pending = self._reconnect_at is not None and not self._disconnecting
+        if not retry_pending:
+            self._reconnect_at = None
+        self._last_seen = None
 
         if self._transport is not None:
             if unsub:
                 self._transport.sendto(b'subscribe(0)\n')
+            if not (self._drain and self._transport.reports_drops):
+                self._kernel_drops += _proc_udp_drops(self._transport) or 0
             self._transport.close()
             self._transport = None
 
@@ -85,12 +116,19 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
             await self.emit('disconnected')
         self._was_connected = False
 
-        if not self._disconnecting:
+        if not self._disconnecting and not retry_pending:
             await self._do_connection()
 
-    def _retry(self):
-        self._reconnect = None
-        asyncio.create_task(self._do_connection())
+    def on_watchdog_tick(self, now):
+        """Drives the reconnect backoff and the inactivity timeout; called
+        periodically by the shared Watchdog."""
+        if self._reconnect_at is not None:
+            if now >= self._reconnect_at:
+                self._reconnect_at = None
+                asyncio.create_task(self._do_connection())
+        elif self._last_seen is not None and now - self._last_seen > INACTIVITY_S:
+            self._last_seen = None
+            asyncio.create_task(self._close_connection())
 
     async def _do_connection(self):
         if self._disconnecting:
@@ -99,20 +137,19 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
             self._backoff += 1
         await self.emit('connecting')
         loop = asyncio.get_running_loop()
-        await loop.create_datagram_endpoint(
-            self.protocol_factory,
-            family = socket.AF_INET,
-            remote_addr = (self._ip, self._port))
-        self._reconnect = loop.call_later(
-            min(5*60, 2**self._backoff + 2), self._retry) # noqa
+        if self._drain:
+            _DrainingTransport(loop, self, (self._ip, self._port), self._rcvbuf)
+        else:
+            await loop.create_datagram_endpoint(
+                self.protocol_factory,
+                family = socket.AF_INET,
+                remote_addr = (self._ip, self._port))
+        self._reconnect_at = time.monotonic() + min(5*60, 2**self._backoff + 2)
 
     def _send_subscribe(self):
         if self._transport is not None:
             self._transport.sendto(b'subscribe(60)\n')
 
-    def _on_inactivity(self):
-        asyncio.create_task(self._close_connection())
-
     # DatagramProtocol support below
 
     def protocol_factory(self):
@@ -120,38 +157,30 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
         return self
 
     def connection_made(self, transport):
+        if self._disconnecting:
+            transport.close() # disconnect() was called while connecting
+            return
         self._transport = transport
+        if self._rcvbuf is not None and not self._drain:
+            transport.get_extra_info('socket').setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
         self._send_subscribe()
 
     def datagram_received(self, data, addr):
-        if self._reconnect is not None:
-            self._reconnect.cancel()
-            self._reconnect = None
+        if self._reconnect_at is not None:
+            self._reconnect_at = None
             self._backoff = 0
             asyncio.create_task(self.emit('connected'))
 
         if not self._was_connected:
             self._was_connected = True
 
-        if self._inactive is not None:
-            self._inactive.cancel()
-        loop = asyncio.get_running_loop()
-        self._inactive = loop.call_later(60, self._on_inactivity) # noqa
+        self._last_seen = time.monotonic()
 
-        lines = data.decode('utf-8').splitlines()
-        for line in lines:
-            try:
-                message = json.loads(line)
-                typ = message['type']
-                if typ == 'subscription':
-                    if message['subtype'] == 'warning':
-                        self._send_subscribe()
-                elif typ == 'discovery':
-                    pass
-                else:
-                    asyncio.create_task(self.emit('message', message))
-            except json.decoder.JSONDecodeError:
-                asyncio.create_task(self.emit('malformed', data))
+        trace = self._start_trace()
+        messages, malformed = self._process(data, trace)
+        if messages or malformed:
+            asyncio.create_task(self._dispatch(messages, malformed, trace))
 
     def error_received(self, exc):
         asyncio.create_task(self._close_connection(False))
@@ -160,12 +189,131 @@ class PlugListenerUdp(AsyncEventEmitter, asyncio.DatagramProtocol):
         if self._transport is not None:
             asyncio.create_task(self._close_connection(False))
 
-    @property
-    def port(self):
-        """Return the TCP port this listener is bound to."""
-        return self._port
+    def _on_kernel_drops(self, count):
+        self._kernel_drops += count
+        asyncio.create_task(self.emit('kernel_drops', count))
 
     @property
-    def ip(self):
-        """Return the IP address this listener is bound to."""
-        return self._ip
+    def kernel_drops(self):
+        """The number of datagrams dropped by the kernel before they could be
+        read, over the lifetime of the listener. In drain mode this is tracked
+        via SO_RXQ_OVFL where supported, otherwise /proc/net/udp is consulted
+        for the current socket. None if neither is available (e.g. not on
+        Linux)."""
+        if self._transport is None:
+            return self._kernel_drops
+        if self._drain and self._transport.reports_drops:
+            return self._kernel_drops
+        drops = _proc_udp_drops(self._transport)
+        return None if drops is None else self._kernel_drops + drops
+
+class _DrainingTransport:
+    """A minimal connected datagram transport, which reads all datagrams
+    ready on the socket whenever it becomes readable, rather than one per
+    event loop iteration as the standard transport does. Datagrams are passed
+    to the protocol as usual."""
+
+    def __init__(self, loop, protocol, remote_addr, rcvbuf=None):
+        self._loop = loop
+        self._protocol = protocol
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        if rcvbuf is not None:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self._ancbufsize = 0
+        self._drops = 0
+        if SO_RXQ_OVFL is not None:
+            try:
+                self._sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._ancbufsize = socket.CMSG_SPACE(4)
+            except (OSError, AttributeError):
+                pass
+        self.reports_drops = self._ancbufsize > 0
+        try:
+            self._sock.connect(remote_addr)
+        except Exception:
+            self._sock.close()
+            raise
+        # As with the standard transports, the protocol is notified on the
+        # next loop iteration. This keeps connection_made() ordered after
+        # the connection_lost() of a transport closed in the same step.
+        self._made = False
+        loop.call_soon(self._connection_made)
+
+    def _connection_made(self):
+        if self._sock is None:
+            return # closed before the protocol was told about it
+        self._made = True
+        self._loop.add_reader(self._sock.fileno(), self._on_readable)
+        self._protocol.connection_made(self)
+
+    def get_extra_info(self, name, default=None):
+        """As per asyncio.BaseTransport."""
+        if name == 'socket':
+            return self._sock
+        if name == 'sockname' and self._sock is not None:
+            return self._sock.getsockname()
+        if name == 'peername' and self._sock is not None:
+            return self._sock.getpeername()
+        return default
+
+    def sendto(self, data, addr=None): # pylint: disable=W0613
+        """As per asyncio.DatagramTransport, always to the connected peer."""
+        if self._sock is None:
+            return
+        try:
+            self._sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            pass # Dropped, as the standard transport would once its buffer fills
+        except OSError as exc:
+            self._protocol.error_received(exc)
+
+    def close(self):
+        """As per asyncio.BaseTransport."""
+        if self._sock is None:
+            return
+        if self._made:
+            self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        if self._made:
+            self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def _on_readable(self):
+        sock = self._sock
+        for _ in range(MAX_DRAIN):
+            if sock is not self._sock:
+                return # closed by the protocol
+            try:
+                data, ancdata, _, addr = sock.recvmsg(MAX_DATAGRAM, self._ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                return
+            for level, typ, cdata in ancdata:
+                if level == socket.SOL_SOCKET and typ == SO_RXQ_OVFL:
+                    # Cumulative count for the socket
+                    drops = struct.unpack('=I', cdata[:4])[0]
+                    if drops > self._drops:
+                        self._protocol._on_kernel_drops(drops - self._drops) # pylint: disable=W0212
+                        self._drops = drops
+            self._protocol.datagram_received(data, addr)
+
+def _proc_udp_drops(transport):
+    """Looks up the kernel drop count for the transport's socket in
+    /proc/net/udp, returning None if unavailable."""
+    sock = transport.get_extra_info('socket')
+    if sock is None:
+        return None
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open('/proc/net/udp', encoding='ascii') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[12])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
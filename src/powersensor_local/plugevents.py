@@ -3,8 +3,8 @@
 """Utility script for accessing the plug api from a single network-local
 Powersensor device. Intended for advanced debugging use only."""
 
+import argparse
 import sys
-from typing import Union
 from pathlib import Path
 
 PROJECT_ROOT = str(Path(__file__).parents[ 1])
@@ -12,54 +12,29 @@ if PROJECT_ROOT not in sys.path:
     sys.path.append(PROJECT_ROOT)
 
 # pylint: disable=C0413
-from powersensor_local.plug_api import PlugApi
-from powersensor_local.abstract_event_handler import AbstractEventHandler
+from powersensor_local.plug_api import PlugApi, PLUG_EVENTS
+from powersensor_local.event_writer import PlugEventWriter
 
-async def print_event_and_message(event, message):
-    """Callback for printing event data."""
-    print(event, message)
-
-class PlugEvents(AbstractEventHandler):
+class PlugEvents(PlugEventWriter):
     """Main logic wrapper."""
-    def __init__(self):
-        self.plug: Union[PlugApi, None] = None
-
-    async def on_exit(self):
-        if self.plug is not None:
-            await self.plug.disconnect()
-            self.plug = None
-
-    async def main(self):
-        if len(sys.argv) < 3:
-            print(f"Syntax: {sys.argv[0]} <id> <ip> [port]")
-            sys.exit(1)
-
-        # Signal handler for Ctrl+C
-        self.register_sigint_handler()
 
-        plug = PlugApi(sys.argv[1], sys.argv[2], *sys.argv[3:3])
-        known_evs = [
-            'exception',
-            'average_flow',
-            'average_power',
-            'average_power_components',
-            'battery_level',
-            'now_relaying_for',
-            'radio_signal_quality',
-            'summation_energy',
-            'summation_volume',
-            'uncalibrated_instant_reading',
-        ]
-        for ev in known_evs:
-            plug.subscribe(ev, print_event_and_message)
-        plug.connect()
+    def _create_plug(self, args):
+        return PlugApi(args.id, args.ip, args.port)
 
-        # Keep the event loop running until Ctrl+C is pressed
-        await self.wait()
+    def _event_names(self, args):
+        known_evs = [ 'exception', *PLUG_EVENTS ]
+        if args.events is not None:
+            known_evs = [ev for ev in known_evs if ev in args.events]
+        return known_evs
 
 def app():
     """Application entry point."""
-    PlugEvents().run()
+    parser = argparse.ArgumentParser(
+        description='Show the event stream from a single Powersensor plug.')
+    parser.add_argument('id', help='the id (MAC address) of the plug')
+    parser.add_argument('ip', help='the IP address of the plug')
+    parser.add_argument('port', nargs='?', type=int, default=49476)
+    PlugEvents.run_app(parser)
 
 if __name__ == "__main__":
     app()
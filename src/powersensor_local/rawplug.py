@@ -3,7 +3,7 @@
 """Utility script for accessing the raw plug subscription data from a single
 network-local Powersensor device. Intended for advanced debugging use only."""
 
-from typing import Union
+import argparse
 import sys
 
 from pathlib import Path
@@ -14,60 +14,30 @@ if PROJECT_ROOT not in sys.path:
 
 # pylint: disable=C0413
 from powersensor_local import PlugListenerTcp,PlugListenerUdp
-from powersensor_local.abstract_event_handler import AbstractEventHandler
+from powersensor_local.event_writer import PlugEventWriter, RAW_FIELDS
 
-async def print_message_ignore_event(_, message):
-    """Callback for printing event data withou the event name."""
-    print(message)
-
-async def print_event(event):
-    """Callback for printing an event."""
-    print(event)
-
-class RawPlug(AbstractEventHandler):
+class RawPlug(PlugEventWriter):
     """Main logic wrapper."""
-    def __init__(self, protocol=None):
-        self.plug: Union[PlugListenerTcp, PlugListenerUdp, None] = None
-        if protocol is None:
-            self._protocol = 'udp'
-        else:
-            self._protocol = 'tcp'
-
-    async def on_exit(self):
-        if self.plug is not None:
-            await self.plug.disconnect()
-            self.plug = None
-
-    async def main(self):
-        if len(sys.argv) < 2:
-            print(f"Syntax: {sys.argv[0]} <ip> [port]")
-            sys.exit(1)
+    def __init__(self, args):
+        super().__init__(args, fields=RAW_FIELDS, repr_with_name=False)
 
-        # Signal handler for Ctrl+C
-        self.register_sigint_handler()
-        if len(sys.argv) >= 4:
-            self._protocol = sys.argv[3]
-        plug = None
-        if self._protocol == 'udp':
-            plug = PlugListenerUdp(sys.argv[1], *sys.argv[2:3])
-        elif self._protocol == 'tcp':
-            plug = PlugListenerTcp(sys.argv[1], *sys.argv[2:3])
-        else:
-            print('Unsupported protocol:', self._protocol)
-        plug.subscribe('exception', print_message_ignore_event)
-        plug.subscribe('message', print_message_ignore_event)
-        plug.subscribe('connecting', print_event)
-        plug.subscribe('connecting', print_event)
-        plug.subscribe('connected', print_event)
-        plug.subscribe('disconnected', print_event)
-        plug.connect()
+    def _create_plug(self, args):
+        if args.proto == 'udp':
+            return PlugListenerUdp(args.ip, args.port)
+        return PlugListenerTcp(args.ip, args.port)
 
-        # Keep the event loop running until Ctrl+C is pressed
-        await self.wait()
+    def _event_names(self, args):
+        return ('exception', 'message', 'malformed',
+                'connecting', 'connected', 'disconnected')
 
 def app():
     """Application entry point."""
-    RawPlug().run()
+    parser = argparse.ArgumentParser(
+        description='Show the raw event stream from a single Powersensor plug.')
+    parser.add_argument('ip', help='the IP address of the plug')
+    parser.add_argument('port', nargs='?', type=int, default=49476)
+    parser.add_argument('proto', nargs='?', choices=('udp', 'tcp'), default='udp')
+    RawPlug.run_app(parser)
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,210 @@
+"""Threshold rules evaluated against the event stream."""
+import operator
+import time
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+# The events a RuleEngine subscribes to in attach()
+RULE_EVENTS = [
+    'average_flow',
+    'average_power',
+    'average_power_components',
+    'battery_level',
+    'radio_signal_quality',
+    'summation_energy',
+    'summation_volume',
+    'uncalibrated_average_reading',
+]
+
+@dataclass(frozen=True)
+class Rule:
+    """A threshold rule, e.g. Rule('kettle', 'a1b2c3d4e5f6', 'average_power',
+    'watts', '>', 3000, hold_s=60).
+
+    rule_id Identifies the rule; adding a rule with the same id replaces it.
+    mac The device the rule applies to, or None for all devices. The rule is
+      tracked separately for each device.
+    event/field The event type and field the rule tests.
+    op/threshold The condition, as in 'value <op> threshold'.
+    hold_s How long the condition must hold before the rule triggers, going
+      by the events' starttime_utc.
+    hysteresis How far back past the threshold the value must go for a
+      triggered rule to clear (not applicable to == and !=).
+    """
+    # pylint: disable=R0902
+    rule_id: Hashable
+    mac: Optional[str]
+    event: str
+    field: str
+    op: str
+    threshold: float
+    hold_s: float = 0
+    hysteresis: float = 0
+
+    def __post_init__(self):
+        if self.op not in OPERATORS:
+            raise ValueError(f'Unsupported operator: {self.op}')
+        if self.hold_s < 0 or self.hysteresis < 0:
+            raise ValueError('hold_s and hysteresis must not be negative')
+
+    @property
+    def clear_threshold(self) -> float:
+        """The threshold the condition is tested against while triggered."""
+        if self.op in ('>', '>='):
+            return self.threshold - self.hysteresis
+        if self.op in ('<', '<='):
+            return self.threshold + self.hysteresis
+        return self.threshold
+
+class _RuleState: # pylint: disable=R0903
+    __slots__ = ('since', 'active')
+
+    def __init__(self, since):
+        self.since = since
+        self.active = False
+
+class RuleEngine(AsyncEventEmitter):
+    """
+    Evaluates threshold rules against the event stream.
+
+    Rules are indexed by (mac, event) and then by field, so each event only
+    touches the rules on its own device (plus those for all devices) which
+    test one of its fields. Rules may be added and removed at any time.
+    State is only kept for rules whose condition currently holds.
+
+    The engine may be subscribed directly to one or more PlugApi instances
+    (see attach()), fed via process_event(), or given the events from
+    PowersensorDevices via process_devices_event().
+
+    The following events are emitted:
+
+    * rule_triggered: When a rule's condition has held for hold_s, with the
+      payload { rule_id: , mac: , event: , field: , value: , threshold: ,
+      since_utc: , timestamp_utc: }
+    * rule_cleared: When the condition of a triggered rule no longer holds
+      (allowing for hysteresis), with the same payload, less since_utc.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._rules = {} # rule_id -> Rule
+        self._index = {} # (mac, event) -> { field: (Rule, ...) }
+        self._states = {} # (rule_id, mac) -> _RuleState
+
+    @property
+    def rules(self) -> list:
+        """All rules, in the order they were added."""
+        return list(self._rules.values())
+
+    def __len__(self):
+        return len(self._rules)
+
+    def add_rule(self, rule: Rule):
+        """Adds a rule, replacing any existing one with the same id."""
+        if rule.rule_id in self._rules:
+            self.remove_rule(rule.rule_id)
+        self._rules[rule.rule_id] = rule
+        fields = self._index.setdefault((rule.mac, rule.event), {})
+        # Copy on write, as rules may be changed by the event handlers
+        fields[rule.field] = fields.get(rule.field, ()) + (rule,)
+
+    def remove_rule(self, rule_id: Hashable) -> Optional[Rule]:
+        """Removes a rule, returning it if it existed. No rule_cleared is
+        emitted for it."""
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return None
+        key = (rule.mac, rule.event)
+        fields = self._index[key]
+        remaining = tuple(r for r in fields[rule.field] if r is not rule)
+        if remaining:
+            fields[rule.field] = remaining
+        else:
+            del fields[rule.field]
+            if not fields:
+                del self._index[key]
+        for state_key in [k for k in self._states if k[0] == rule_id]:
+            del self._states[state_key]
+        return rule
+
+    def active(self) -> list:
+        """Returns the (rule_id, mac) pairs of the currently triggered rules."""
+        return [key for key, state in self._states.items() if state.active]
+
+    def attach(self, emitter: AsyncEventEmitter):
+        """Subscribes to the RULE_EVENTS on e.g. a PlugApi instance."""
+        for name in RULE_EVENTS:
+            emitter.subscribe(name, self.process_event)
+
+    def detach(self, emitter: AsyncEventEmitter):
+        """Reverses attach()."""
+        for name in RULE_EVENTS:
+            emitter.unsubscribe(name, self.process_event)
+
+    async def process_devices_event(self, obj: dict):
+        """Evaluates an event as delivered by PowersensorDevices."""
+        await self.process_event(obj['event'], obj)
+
+    async def process_event(self, event_name: str, ev: dict):
+        """Evaluates the rules applicable to an event."""
+        mac = ev.get('mac')
+        for index_mac in (mac, None) if mac is not None else (None,):
+            fields = self._index.get((index_mac, event_name))
+            if not fields:
+                continue
+            # The handlers of the emitted events may add or remove rules
+            for field, rules in list(fields.items()):
+                value = ev.get(field)
+                if value is not None:
+                    await self._evaluate(rules, mac, ev, value)
+
+    async def _evaluate(self, rules, mac, ev, value):
+        now = ev.get('starttime_utc')
+        if now is None:
+            now = time.time()
+        states = self._states
+        for rule in rules:
+            if self._rules.get(rule.rule_id) is not rule:
+                continue # removed or replaced by a handler of this event
+            key = (rule.rule_id, mac)
+            state = states.get(key)
+            if state is not None and state.active:
+                if not OPERATORS[rule.op](value, rule.clear_threshold):
+                    states.pop(key, None)
+                    await self._emit_rule('rule_cleared', rule, mac, value, now)
+                continue
+            if not OPERATORS[rule.op](value, rule.threshold):
+                if state is not None:
+                    states.pop(key, None)
+                continue
+            if state is None:
+                state = states[key] = _RuleState(now)
+            if now - state.since >= rule.hold_s:
+                state.active = True
+                await self._emit_rule('rule_triggered', rule, mac, value, now,
+                                      state.since)
+
+    async def _emit_rule(self, name, rule, mac, value, now, since=None): # pylint: disable=R0913,R0917
+        ev = {
+            'rule_id': rule.rule_id,
+            'mac': mac,
+            'event': rule.event,
+            'field': rule.field,
+            'value': value,
+            'threshold': rule.threshold,
+        }
+        if since is not None:
+            ev['since_utc'] = since
+        ev['timestamp_utc'] = now
+        await self.emit(name, ev)
@@ -0,0 +1,246 @@
+"""Last-value state of all devices, updated in place as events arrive."""
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Iterable, Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter
+
+MAX_TOMBSTONES = 4096
+
+# Event name -> (event field, state field) pairs taken from it
+EVENT_FIELDS = {
+    'average_power': (
+        ('watts', 'watts'), ('duration_s', 'duration_s')),
+    'average_power_components': (
+        ('apparent_current', 'apparent_current'),
+        ('active_current', 'active_current'),
+        ('reactive_current', 'reactive_current'),
+        ('volts', 'volts')),
+    'summation_energy': (
+        ('summation_joules', 'summation_joules'),
+        ('summation_resettime_utc', 'summation_resettime_utc')),
+    'average_flow': (
+        ('litres_per_minute', 'litres_per_minute'), ('duration_s', 'duration_s')),
+    'summation_volume': (
+        ('summation_litres', 'summation_litres'),
+        ('summation_resettime_utc', 'summation_resettime_utc')),
+    'uncalibrated_average_reading': (
+        ('value', 'uncalibrated_value'), ('duration_s', 'duration_s')),
+    'battery_level': (
+        ('volts', 'battery_volts'),),
+    'radio_signal_quality': (
+        ('average_rssi', 'average_rssi'), ('last_rssi', 'last_rssi')),
+    'now_relaying_for': (
+        ('device_type', 'device_type'),),
+}
+
+class DeviceState: # pylint: disable=R0902,R0903
+    """The latest known values for a single device. Fields not (yet)
+    reported are None."""
+    __slots__ = (
+        'mac', 'device_type', 'role', 'via', 'version', 'updated_utc',
+        'watts', 'duration_s', 'apparent_current', 'active_current',
+        'reactive_current', 'volts', 'summation_joules',
+        'summation_resettime_utc', 'litres_per_minute', 'summation_litres',
+        'uncalibrated_value', 'battery_volts', 'average_rssi', 'last_rssi',
+    )
+
+    def __init__(self, mac: str):
+        self.mac = mac
+        self.device_type = None
+        self.role = None
+        self.via = None
+        self.version = 0
+        self.updated_utc = None
+        self.watts = None
+        self.duration_s = None
+        self.apparent_current = None
+        self.active_current = None
+        self.reactive_current = None
+        self.volts = None
+        self.summation_joules = None
+        self.summation_resettime_utc = None
+        self.litres_per_minute = None
+        self.summation_litres = None
+        self.uncalibrated_value = None
+        self.battery_volts = None
+        self.average_rssi = None
+        self.last_rssi = None
+
+    def as_dict(self) -> dict:
+        """Returns the state as a dict, omitting unknown fields."""
+        out = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                out[name] = value
+        return out
+
+class StateChanges: # pylint: disable=R0903
+    """The result of DeviceStateStore.changes_since().
+
+    version The store version the changes bring the caller up to.
+    devices The changed devices, as a dict of MAC address to state dict.
+    removed The MAC addresses of the removed devices.
+    full True if devices holds all devices, rather than just the changed
+      ones, because the removals since the given version are no longer
+      known. Any devices not listed should then be discarded.
+    """
+    __slots__ = ('version', 'devices', 'removed', 'full')
+
+    def __init__(self, version, devices, removed, full):
+        self.version = version
+        self.devices = devices
+        self.removed = removed
+        self.full = full
+
+class DeviceStateStore:
+    """
+    Keeps the latest values reported by every device (watts, volts,
+    summation, battery, RSSI, ...), along with the plug relaying for it, in
+    a fixed DeviceState per device which is updated in place.
+
+    Every change bumps the store version, and stamps it on the changed
+    device. Pollers can then fetch only what changed with changes_since(),
+    which only visits the changed devices. A snapshot of all devices is
+    available from snapshot(), which is cached until the next change.
+
+    Feed events in via update() (or the process_event() handler, e.g. via
+    attach() to a PlugApi), or pass the store to PowersensorDevices.
+    """
+
+    def __init__(self):
+        self._devices = OrderedDict() # mac -> DeviceState, least recently changed first
+        self._removed = OrderedDict() # mac -> version, oldest first
+        self._removed_floor = 0
+        self.version = 0
+        self._snapshot = MappingProxyType({})
+        self._snapshot_version = 0
+        self._snapshot_dicts = {}
+
+    def get(self, mac: str) -> Optional[DeviceState]:
+        """Returns the live state of the given device, if known."""
+        return self._devices.get(mac)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, mac):
+        return mac in self._devices
+
+    def add(self, mac: str, device_type: Optional[str] = None) -> DeviceState:
+        """Returns the state for the given device, creating it if needed."""
+        state = self._devices.get(mac)
+        if state is None:
+            state = self._devices[mac] = DeviceState(mac)
+            self._removed.pop(mac, None)
+            self._touch(state)
+        if device_type is not None and state.device_type != device_type:
+            state.device_type = device_type
+            self._touch(state)
+        return state
+
+    def remove(self, mac: str):
+        """Forgets a device, e.g. when it's no longer present."""
+        if self._devices.pop(mac, None) is None:
+            return
+        self.version += 1
+        self._removed[mac] = self.version
+        if len(self._removed) > MAX_TOMBSTONES:
+            _, self._removed_floor = self._removed.popitem(last=False)
+
+    def update(self, event_name: str, ev: dict):
+        """Applies an event to the state of the device it's about. Events
+        without a known mapping are ignored."""
+        if event_name == 'no_longer_relaying_for':
+            state = self._devices.get(ev.get('mac'))
+            if state is not None and state.via == ev.get('via'):
+                state.via = None
+                self._touch(state)
+            return
+        fields = EVENT_FIELDS.get(event_name)
+        mac = ev.get('mac')
+        if fields is None or mac is None:
+            return
+        state = self._devices.get(mac)
+        if state is None:
+            state = self._devices[mac] = DeviceState(mac)
+            self._removed.pop(mac, None)
+        for src, dst in fields:
+            value = ev.get(src)
+            if value is not None:
+                setattr(state, dst, value)
+        role = ev.get('role')
+        if role is not None:
+            state.role = role
+        via = ev.get('via')
+        if via is not None:
+            state.via = via
+        starttime = ev.get('starttime_utc')
+        if starttime is not None:
+            state.updated_utc = starttime
+        self._touch(state)
+
+    async def process_event(self, event_name: str, ev: dict):
+        """update() in the form of an AsyncEventEmitter handler."""
+        self.update(event_name, ev)
+
+    def attach(self, emitter: AsyncEventEmitter, events: Iterable[str] = None):
+        """Subscribes to the events with a mapping on e.g. a PlugApi."""
+        for name in events if events is not None else self._handled_events():
+            emitter.subscribe(name, self.process_event)
+
+    def detach(self, emitter: AsyncEventEmitter, events: Iterable[str] = None):
+        """Reverses attach()."""
+        for name in events if events is not None else self._handled_events():
+            emitter.unsubscribe(name, self.process_event)
+
+    def changes_since(self, version: int) -> StateChanges:
+        """Returns the changes made after the given store version. Pass 0
+        to get everything; pass the returned version on the next call."""
+        full = version < self._removed_floor
+        devices = {}
+        if full:
+            devices = { mac: s.as_dict() for mac, s in self._devices.items() }
+            removed = []
+        else:
+            for state in reversed(self._devices.values()):
+                if state.version <= version:
+                    break
+                devices[state.mac] = state.as_dict()
+            removed = []
+            for mac, ver in reversed(self._removed.items()):
+                if ver <= version:
+                    break
+                removed.append(mac)
+        return StateChanges(self.version, devices, removed, full)
+
+    def snapshot(self) -> MappingProxyType:
+        """Returns a read-only mapping of MAC address to state dict for all
+        devices, as of the current version. The same object is returned
+        until the next change, and it's never modified afterwards. Only the
+        changed devices are re-serialised when a new one is built."""
+        if self._snapshot_version == self.version:
+            return self._snapshot
+        dicts = self._snapshot_dicts
+        changes = self.changes_since(self._snapshot_version)
+        if changes.full:
+            dicts = changes.devices
+        else:
+            dicts = dict(dicts)
+            dicts.update(changes.devices)
+            for mac in changes.removed:
+                dicts.pop(mac, None)
+        self._snapshot_dicts = dicts
+        self._snapshot = MappingProxyType(dicts)
+        self._snapshot_version = changes.version
+        return self._snapshot
+
+    def _touch(self, state: DeviceState):
+        self.version += 1
+        state.version = self.version
+        self._devices.move_to_end(state.mac)
+
+    @staticmethod
+    def _handled_events():
+        return [*EVENT_FIELDS, 'no_longer_relaying_for']
@@ -0,0 +1,174 @@
+"""Bridge for consuming events from threads not running an asyncio loop."""
+import asyncio
+import threading
+from collections import deque
+from typing import Iterable, Optional
+
+from powersensor_local.devices import PowersensorDevices
+from powersensor_local.plug_api import PlugApi, PLUG_EVENTS
+
+# pylint: disable=R0902
+class ThreadBridge:
+    """
+    Runs PlugApi/PowersensorDevices instances on a dedicated event loop
+    thread, and hands their events to consumer threads.
+
+    Events are appended to a deque, whose append/popleft operations are
+    atomic, so the loop thread never blocks on a consumer. A consumer only
+    costs a wake-up when it is actually waiting. Consumers fetch events in
+    batches via get_many(), as (event_name, event) tuples. For events from
+    PowersensorDevices, the event name is that of the 'event' field.
+
+    Example:
+
+      with ThreadBridge() as bridge:
+          bridge.add_plug('aabbccddeeff', '192.168.0.10')
+          while True:
+              for name, ev in bridge.get_many(timeout=1):
+                  ...
+    """
+
+    def __init__(self, maxlen: Optional[int] = None):
+        """Constructor.
+        maxlen The maximum number of events to hold for consumers. When
+          exceeded, the oldest events are discarded and counted in 'dropped'.
+          Unbounded if None.
+        """
+        self._maxlen = maxlen
+        self._items = deque()
+        self._ready = threading.Event()
+        self._loop = None
+        self._thread = None
+        self._plugs = []
+        self._devices = []
+        self.dropped = 0
+
+    def start(self):
+        """Starts the event loop thread. Idempotent."""
+        if self._thread is not None:
+            return
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(started,),
+            name='powersensor-bridge', daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self, timeout: float = 5):
+        """Disconnects all plugs/devices, stops the event loop thread and
+        wakes up any waiting consumers. Events already queued may still be
+        retrieved."""
+        if self._thread is None:
+            return
+        try:
+            self.run_coroutine(self._shutdown(), timeout)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+            self._ready.set()
+
+    def run_coroutine(self, coro, timeout: Optional[float] = None):
+        """Runs the given coroutine on the bridge's event loop, and returns
+        its result."""
+        if self._loop is None:
+            raise RuntimeError('bridge not started')
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def add_plug(self, mac: str, ip: str, port: int = 49476, proto: str = 'udp',
+                 events: Iterable[str] = PLUG_EVENTS) -> PlugApi:
+        """Creates and connects a PlugApi on the bridge thread, forwarding the
+        given events to consumers. Starts the bridge if necessary."""
+        self.start()
+        return self.run_coroutine(self._add_plug(mac, ip, port, proto, events))
+
+    def add_devices(self, bcast_addr: str = '<broadcast>',
+                    subscribe_all: bool = True) -> PowersensorDevices:
+        """Creates and starts a PowersensorDevices on the bridge thread,
+        forwarding its events to consumers. If subscribe_all is set, every
+        found device is subscribed to. Starts the bridge if necessary."""
+        self.start()
+        return self.run_coroutine(self._add_devices(bcast_addr, subscribe_all))
+
+    def get_many(self, max_items: int = 1000, block: bool = True,
+                 timeout: Optional[float] = None) -> list:
+        """Returns up to max_items pending events. If none are pending and
+        block is set, waits up to timeout seconds (forever if None) for one to
+        arrive. Returns an empty list if nothing arrived, or the bridge was
+        stopped."""
+        items = self._items
+        while True:
+            out = []
+            while items and len(out) < max_items:
+                out.append(items.popleft())
+            if out or not block or self._thread is None:
+                return out
+            self._ready.clear()
+            # Re-check to not miss an event appended before the clear()
+            if items:
+                continue
+            if not self._ready.wait(timeout):
+                return []
+            timeout = None if timeout is None else 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self, started: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+            self._loop = None
+
+    def _put(self, item):
+        items = self._items
+        if self._maxlen is not None and len(items) >= self._maxlen:
+            try:
+                items.popleft()
+                self.dropped += 1
+            except IndexError:
+                pass # Emptied by a consumer in the meantime
+        items.append(item)
+        if not self._ready.is_set():
+            self._ready.set()
+
+    async def _on_plug_event(self, event_name, ev):
+        self._put((event_name, ev))
+
+    async def _add_plug(self, mac, ip, port, proto, events):
+        api = PlugApi(mac, ip, port, proto)
+        for name in events:
+            api.subscribe(name, self._on_plug_event)
+        api.connect()
+        self._plugs.append(api)
+        return api
+
+    async def _add_devices(self, bcast_addr, subscribe_all):
+        devices = PowersensorDevices(bcast_addr)
+        async def on_event(obj):
+            if subscribe_all and obj['event'] == 'device_found':
+                devices.subscribe(obj['mac'])
+            self._put((obj['event'], obj))
+        self._devices.append(devices)
+        await devices.start(on_event)
+        return devices
+
+    async def _shutdown(self):
+        for api in self._plugs:
+            await api.disconnect()
+        for devices in self._devices:
+            await devices.stop()
+        self._plugs = []
+        self._devices = []
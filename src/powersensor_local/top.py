@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""A top-style view of all network-local Powersensor devices, for spotting
+stalled or noisy devices. Intended for diagnostic use only.
+
+Events only update a handful of counters per device; the view itself is
+rendered at a fixed interval, and only as many rows as fit the terminal are
+formatted.
+"""
+import argparse
+import asyncio
+import shutil
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = str(Path(__file__).parents[1])
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+# pylint: disable=C0413
+from powersensor_local.devices import PowersensorDevices
+from powersensor_local.abstract_event_handler import AbstractEventHandler, add_loop_argument
+
+SORT_KEYS = {
+    'rate': lambda d: -d.rate,
+    'age': lambda d: d.last_seen if d.last_seen is not None else float('-inf'),
+    'mac': lambda d: d.mac,
+    'watts': lambda d: -(d.watts or 0),
+}
+
+CLEAR = '\x1b[H\x1b[2J'
+
+class DeviceStats: # pylint: disable=R0902,R0903
+    """Per-device counters, updated for each event."""
+    __slots__ = ('mac', 'device_type', 'via', 'count', 'rate', 'watts',
+                 'rssi', 'volts', 'last_seen')
+
+    def __init__(self, mac, device_type=None):
+        self.mac = mac
+        self.device_type = device_type
+        self.via = None
+        self.count = 0
+        self.rate = 0.0
+        self.watts = None
+        self.rssi = None
+        self.volts = None
+        self.last_seen = None
+
+class TopRunner(AbstractEventHandler):
+    """Main logic wrapper."""
+    def __init__(self, interval_s: float = 2.0, sort: str = 'rate'):
+        self.devices = PowersensorDevices()
+        self.stats = {}
+        self.interval_s = interval_s
+        self.sort = sort
+        self._since = time.monotonic()
+
+    async def on_exit(self):
+        await self.devices.stop()
+
+    async def on_message(self, obj):
+        """Updates the per-device counters for an event."""
+        event = obj['event']
+        mac = obj.get('mac')
+        if mac is None:
+            return
+        stats = self.stats.get(mac)
+        if stats is None:
+            stats = self.stats[mac] = DeviceStats(mac)
+        if event == 'device_found':
+            stats.device_type = obj.get('device_type')
+            self.devices.subscribe(mac)
+            return
+        if event == 'device_lost':
+            del self.stats[mac]
+            return
+        stats.count += 1
+        stats.last_seen = time.monotonic()
+        if event == 'average_power':
+            stats.watts = obj.get('watts')
+            stats.via = obj.get('via')
+        elif event == 'radio_signal_quality':
+            stats.rssi = obj.get('average_rssi')
+        elif event == 'battery_level':
+            stats.volts = obj.get('volts')
+
+    def render(self) -> str:
+        """Returns the current view, and restarts the rate measurement."""
+        now = time.monotonic()
+        elapsed = max(now - self._since, 1e-9)
+        self._since = now
+        total = 0
+        for stats in self.stats.values():
+            total += stats.count
+            stats.rate = stats.count / elapsed
+            stats.count = 0
+
+        size = shutil.get_terminal_size()
+        rows = sorted(self.stats.values(), key=SORT_KEYS[self.sort])
+        rows = rows[:max(size.lines - 4, 1)]
+        plugs = self.devices.plugs
+        lines = [
+            f'{len(self.stats)} devices, {len(plugs)} plugs, '
+            f'{total / elapsed:.1f} events/s, '
+            f'{self.devices.duplicates_dropped} duplicates dropped',
+            '',
+            f"{'MAC':<16} {'TYPE':<6} {'VIA':<16} {'MSG/S':>7} {'WATTS':>9} "
+            f"{'RSSI':>6} {'BATT V':>6} {'RECONN':>6} {'MALFRM':>6} {'AGE S':>6}",
+        ]
+        for stats in rows:
+            api = plugs.get(stats.mac)
+            lines.append(
+                f'{stats.mac:<16} {stats.device_type or "-":<6} '
+                f'{stats.via or "-":<16} {stats.rate:7.1f} '
+                f'{_fmt(stats.watts, 9, 1)} {_fmt(stats.rssi, 6, 1)} '
+                f'{_fmt(stats.volts, 6, 2)} '
+                f'{_fmt(api and api.reconnects, 6, 0)} '
+                f'{_fmt(api and api.malformed, 6, 0)} '
+                f'{_fmt(stats.last_seen and now - stats.last_seen, 6, 0)}')
+        return '\n'.join(lines) + '\n'
+
+    async def main(self):
+        # Signal handler for Ctrl+C
+        self.register_sigint_handler()
+
+        await self.devices.start(self.on_message)
+        tty = sys.stdout.isatty()
+        while not self.exiting:
+            await asyncio.sleep(self.interval_s)
+            sys.stdout.write((CLEAR if tty else '\n') + self.render())
+            sys.stdout.flush()
+
+def _fmt(value, width, decimals):
+    if value is None:
+        return f"{'-':>{width}}"
+    return f'{value:{width}.{decimals}f}'
+
+def app():
+    """Application entry point."""
+    parser = argparse.ArgumentParser(
+        description='Show a continuously updated overview of all '
+                    'network-local Powersensor devices.')
+    parser.add_argument('--interval', type=float, default=2.0, metavar='SECONDS',
+                        help='refresh interval (default: 2.0)')
+    parser.add_argument('--sort', choices=SORT_KEYS, default='rate',
+                        help='sort order; "age" shows stalled devices first '
+                             '(default: rate)')
+    add_loop_argument(parser)
+    args = parser.parse_args()
+    TopRunner(args.interval, args.sort).run(args.loop)
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,178 @@
+"""Latency tracing from the device timestamp through to the event handlers.
+
+A LatencyTracer attached to a PlugApi records, for every traced event:
+
+  age       receive time - (starttime_utc + duration_s), i.e. how long after
+            the end of the measurement interval it arrived. This covers
+            device side batching and network delay (and any clock skew
+            between the device and this host).
+  decode    from receipt at the socket until decoded
+  translate from receipt until translated into events
+  handler   from receipt until each event handler is called, showing event
+            loop congestion and time spent in preceding handlers
+
+Receipt is when the listener gets the data from the event loop, so time
+spent queued in the kernel shows up in 'age'.
+
+The trace of the message being processed is carried in the current_trace
+context variable, which is only consulted while a tracer is attached
+anywhere, to keep the cost nil when tracing is not in use.
+"""
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+STAGES = ('age', 'decode', 'translate', 'handler')
+
+# Bucket upper bounds in ms, from 0.1 ms to ~74 s in steps of sqrt(2)
+BOUNDS_MS = tuple(0.1 * 2 ** (i / 2) for i in range(40))
+
+current_trace: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+
+# The number of tracers attached, checked on every emit
+active = 0 # pylint: disable=C0103
+
+class LatencyHistogram:
+    """A histogram of latencies over logarithmically spaced buckets."""
+    __slots__ = ('counts', 'count', 'total_ms', 'min_ms', 'max_ms')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+
+    def record(self, ms: float):
+        """Adds a latency, in milliseconds."""
+        self.counts[bisect_left(BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if self.min_ms is None or ms < self.min_ms:
+            self.min_ms = ms
+        if self.max_ms is None or ms > self.max_ms:
+            self.max_ms = ms
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the upper bound of the bucket holding the q quantile
+        (capped by the maximum seen), or None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(BOUNDS_MS):
+                    return min(BOUNDS_MS[i], self.max_ms)
+                break
+        return self.max_ms
+
+    def as_dict(self) -> dict:
+        """Returns the count, mean, min, max, p50 and p99, in ms."""
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else None,
+            'min_ms': self.min_ms,
+            'max_ms': self.max_ms,
+            'p50_ms': self.quantile(0.5),
+            'p99_ms': self.quantile(0.99),
+        }
+
+class Trace: # pylint: disable=R0903
+    """The timestamps of a single received datagram/line. The perf_counter
+    stamps are seconds; rx_utc is the wall clock time of receipt."""
+    __slots__ = ('tracer', 'rx_utc', 'rx', 'decoded', 'translated', 'event')
+
+    def __init__(self, tracer: 'LatencyTracer'):
+        self.tracer = tracer
+        self.rx_utc = time.time()
+        self.rx = time.perf_counter()
+        self.decoded = None
+        self.translated = None
+        self.event = None
+
+class LatencyTracer:
+    """
+    Collects per-device latency histograms for the stages listed in STAGES.
+    Attach to one or more PlugApi instances with attach().
+
+    With annotate set, each traced event also gets a 'latency' field:
+
+      { rx_utc: , age_ms: , decode_ms: , translate_ms: }
+
+    Note that the events then no longer match their documented form, e.g.
+    the codec module will reject them.
+    """
+
+    def __init__(self, annotate: bool = False):
+        self.annotate = annotate
+        self._histograms = {} # mac -> { stage: LatencyHistogram }
+        self._attached = []
+
+    def attach(self, plug_api):
+        """Starts tracing the events of the given PlugApi."""
+        global active # pylint: disable=W0603
+        plug_api.tracer = self
+        self._attached.append(plug_api)
+        active += 1
+
+    def detach(self, plug_api):
+        """Reverses attach()."""
+        global active # pylint: disable=W0603
+        if plug_api in self._attached:
+            self._attached.remove(plug_api)
+            plug_api.tracer = None
+            active -= 1
+
+    def start(self) -> Trace:
+        """Returns a new trace, stamped with the receive time."""
+        return Trace(self)
+
+    def histogram(self, mac: str, stage: str) -> LatencyHistogram:
+        """Returns the histogram for the given device and stage."""
+        return self._stages(mac)[stage]
+
+    def _stages(self, mac: str) -> dict:
+        stages = self._histograms.get(mac)
+        if stages is None:
+            stages = self._histograms[mac] = {s: LatencyHistogram() for s in STAGES}
+        return stages
+
+    def stats(self) -> dict:
+        """Returns all histograms, as { mac: { stage: {...} } }."""
+        return {
+            mac: {stage: hist.as_dict() for stage, hist in stages.items()}
+            for mac, stages in self._histograms.items()
+        }
+
+    def reset(self):
+        """Discards all recorded latencies."""
+        self._histograms = {}
+
+    def on_translated(self, trace: Trace, ev: dict):
+        """Records the receive, decode and translate stages of an event."""
+        stages = self._stages(ev.get('mac'))
+        decode_ms = (trace.decoded - trace.rx) * 1000
+        translate_ms = (trace.translated - trace.rx) * 1000
+        stages['decode'].record(decode_ms)
+        stages['translate'].record(translate_ms)
+        age_ms = None
+        start = ev.get('starttime_utc')
+        if start is not None:
+            age_ms = (trace.rx_utc - start - (ev.get('duration_s') or 0)) * 1000
+            stages['age'].record(age_ms)
+        if self.annotate:
+            ev['latency'] = {
+                'rx_utc': trace.rx_utc,
+                'age_ms': age_ms,
+                'decode_ms': decode_ms,
+                'translate_ms': translate_ms,
+            }
+
+    def on_handler(self, trace: Trace):
+        """Records the handler stage, as a handler of the traced event is
+        about to be called."""
+        ms = (time.perf_counter() - trace.rx) * 1000
+        self._stages(trace.event.get('mac'))['handler'].record(ms)
@@ -1,15 +1,14 @@
 """Abstraction for producing a household view."""
 
-import sys
-from pathlib import Path
+import math
+import os
+import struct
+import time
+import zlib
 from dataclasses import dataclass
+from functools import partial
 from typing import Optional
 
-PROJECT_ROOT = str(Path(__file__).parents[1])
-if PROJECT_ROOT not in sys.path:
-    sys.path.append(PROJECT_ROOT)
-
-# pylint: disable=C0413
 from powersensor_local.async_event_emitter import AsyncEventEmitter
 from powersensor_local.event_buffer import EventBuffer
 
@@ -19,6 +18,16 @@ KEY_START = 'starttime_utc'
 KEY_SUM_J = 'summation_joules'
 KEY_WATTS = 'watts'
 
+CHECKPOINT_INTERVAL_S = 60
+
+# magic, version, expect solar, then as doubles (NaN for None): the last
+# summation time, and the SummationInfo and Counters fields in declaration
+# order
+_CHECKPOINT = struct.Struct('<4sBB' + 'd' * 10)
+_CHECKPOINT_MAGIC = b'PSVH'
+_CHECKPOINT_VERSION = 1
+_CRC = struct.Struct('<I')
+
 @dataclass
 class InstantaneousValues: # pylint: disable=C0115
     starttime_utc: int
@@ -41,6 +50,13 @@ class SummationDeltas: # pylint: disable=C0115
     from_grid: float
     home_use: float
 
+def _restore_number(value: float):
+    """Undoes the conversions of None (to NaN) and of whole numbers (to
+    float) in checkpoints."""
+    if math.isnan(value):
+        return None
+    return int(value) if value.is_integer() else value
+
 def same_duration(ev1: dict, ev2: dict):
     """Close-enough matching of duration_s in events."""
     dur = KEY_DUR_S
@@ -51,64 +67,127 @@ def same_duration(ev1: dict, ev2: dict):
     d2 = round(ev2[dur], 0)
     return d1 == d2
 
-def matching_instants(
-        starttime_utc: int,
-        solar_events: EventBuffer,
-        housenet_events: EventBuffer) -> Optional[InstantaneousValues]:
-    """Attempts to match and merge solar+housenet average_power events."""
-    solar = solar_events.find_by_key(KEY_START, starttime_utc)
-    housenet = housenet_events.find_by_key(KEY_START, starttime_utc)
-    if solar is not None and housenet is not None and same_duration(solar, housenet):
-        return InstantaneousValues(
-            starttime_utc = starttime_utc,
-            solar_watts = solar[KEY_WATTS],
-            housenet_watts = housenet[KEY_WATTS],
-            duration_s = round(solar[KEY_DUR_S], 0),
-        )
-    return None
+def merge_instants(solar: dict, housenet: dict) -> InstantaneousValues:
+    """Merges a matched pair of solar+housenet average_power events."""
+    return InstantaneousValues(
+        starttime_utc = int(housenet[KEY_START]),
+        solar_watts = solar[KEY_WATTS],
+        housenet_watts = housenet[KEY_WATTS],
+        duration_s = round(solar[KEY_DUR_S], 0),
+    )
 
 def make_instant_housenet(ev: dict) -> Optional[InstantaneousValues]:
     """Helper for case where no solar merge is expected."""
     if ev is None:
         return None
     return InstantaneousValues(
-        starttime_utc = ev[KEY_START],
+        starttime_utc = int(ev[KEY_START]),
         solar_watts = 0,
         housenet_watts = ev[KEY_WATTS],
         duration_s = round(ev[KEY_DUR_S], 0)
     )
 
-def matching_summations(
-        starttime_utc: int,
-        solar_events: EventBuffer,
-        housenet_events: EventBuffer) -> Optional[SummationValues]:
-    """Attempts to match and merge solar+housenet summation events."""
-    solar = solar_events.find_by_key(KEY_START, starttime_utc)
-    housenet = housenet_events.find_by_key(KEY_START, starttime_utc)
-    if solar is not None and housenet is not None:
-        return SummationValues(
-            starttime_utc = starttime_utc,
-            solar_summation =solar[KEY_SUM_J],
-            solar_resettime = solar[KEY_RESET],
-            housenet_summation = housenet[KEY_SUM_J],
-            housenet_resettime = housenet[KEY_RESET],
-        )
-    return None
+def merge_summations(solar: dict, housenet: dict) -> SummationValues:
+    """Merges a matched pair of solar+housenet summation events."""
+    return SummationValues(
+        starttime_utc = int(housenet[KEY_START]),
+        solar_summation =solar[KEY_SUM_J],
+        solar_resettime = solar[KEY_RESET],
+        housenet_summation = housenet[KEY_SUM_J],
+        housenet_resettime = housenet[KEY_RESET],
+    )
 
 def make_summation_housenet(ev: dict) -> Optional[SummationValues]:
     """Helper for case where no solar merge is expected."""
     if ev is None:
         return None
     return SummationValues(
-        starttime_utc = ev[KEY_START],
+        starttime_utc = int(ev[KEY_START]),
         solar_summation = 0,
         solar_resettime = 0,
         housenet_summation = ev[KEY_SUM_J],
         housenet_resettime = ev[KEY_RESET]
     )
 
+@dataclass
+class JoinStats: # pylint: disable=C0115
+    matched: int = 0
+    unmatched: int = 0
+    late: int = 0
+
+class WatermarkJoin:
+    """
+    Windowed join of solar and house-net events.
 
+    Events are paired with the closest event of the other role whose
+    starttime_utc is within the match tolerance. The watermark trails the
+    newest starttime_utc seen by the allowed lateness; buffered events older
+    than the watermark can no longer be paired and are dropped as unmatched,
+    while arriving events older than the watermark are dropped as late.
+    """
 
+    def __init__(self, keep: int, tolerance_s: float, lateness_s: float,
+                 compatible = None):
+        self._solar = EventBuffer(keep)
+        self._housenet = EventBuffer(keep)
+        self._tolerance = tolerance_s
+        self._lateness = lateness_s
+        self._compatible = compatible
+        self._watermark = None
+        self.stats = JoinStats()
+
+    def offer(self, role: str, ev: dict):
+        """Offers a new event for joining. Returns the (solar, housenet) pair
+        if a match was made, otherwise None."""
+        start = ev[KEY_START]
+        if self.is_late(start):
+            self.stats.late += 1
+            return None
+
+        if role == 'solar':
+            own, other = self._solar, self._housenet
+        else:
+            own, other = self._housenet, self._solar
+
+        predicate = None
+        if self._compatible is not None:
+            predicate = partial(self._compatible, ev)
+        match = other.find_nearest(KEY_START, start, self._tolerance, predicate)
+        if match is not None:
+            other.remove(match)
+            self.stats.matched += 1
+        elif own.append(ev) is not None:
+            self.stats.unmatched += 1
+
+        self._advance(start)
+        if match is None:
+            return None
+        return (ev, match) if role == 'solar' else (match, ev)
+
+    def single(self, ev: dict) -> Optional[dict]:
+        """Accounts for an event which needs no join (housenet-only).
+        Returns the event, or None if it was dropped as late."""
+        start = ev[KEY_START]
+        if self.is_late(start):
+            self.stats.late += 1
+            return None
+        self._advance(start)
+        self.stats.matched += 1
+        return ev
+
+    def is_late(self, starttime_utc: float) -> bool:
+        """Whether an event with the given start time is behind the watermark."""
+        return self._watermark is not None and starttime_utc < self._watermark
+
+    def _advance(self, starttime_utc: float):
+        watermark = starttime_utc - self._lateness
+        if self._watermark is None or watermark > self._watermark:
+            self._watermark = watermark
+            self.stats.unmatched += self._solar.evict_before(KEY_START, watermark)
+            self.stats.unmatched += self._housenet.evict_before(KEY_START, watermark)
+
+
+# pylint: disable=R0902
 class VirtualHousehold(AsyncEventEmitter):
     """
     Class for processing average_power and summation_energy events into
@@ -117,7 +196,28 @@ class VirtualHousehold(AsyncEventEmitter):
     To use, simply feed the appropriate PlugApi events to the
     process_average_power_event and process_summation_event member functions.
 
-    Point-in-time power flow events include:
+    Solar and house-net readings are paired when their starttime_utc values
+    are within the match tolerance of each other. Readings arriving more than
+    the allowed lateness behind the newest reading seen are dropped, as are
+    buffered readings which could not be paired in that time. These are
+    counted in join_stats.
+
+    For each paired interval, a single combined record is emitted:
+
+    * household_power, with the payload
+
+      { timestamp_utc: , duration_s: , from_grid_watts: , home_usage_watts: ,
+        solar_generation_watts: , to_grid_watts: }
+
+    * household_summation, with the payload
+
+      { timestamp_utc: , summation_resettime_utc: , from_grid_joules: ,
+        home_usage_joules: , solar_generation_joules: , to_grid_joules: }
+
+    The solar_generation and to_grid fields are only present for solar kits.
+
+    The individual point-in-time power flow events are also available, and
+    are only emitted while they have subscribers:
 
     * home_usage
     * from_grid
@@ -128,7 +228,7 @@ class VirtualHousehold(AsyncEventEmitter):
 
       { timestamp_utc: , watts: }
 
-    Energy summation events include:
+    Likewise for the individual energy summation events:
 
     * home_usage_summation
     * from_grid_summation
@@ -141,100 +241,181 @@ class VirtualHousehold(AsyncEventEmitter):
 
     Summations may reset at any time. Track the summation_resettime_utc
     field to take note of summation resets.
+
+    To carry the summation counters across restarts, rather than starting
+    them (and summation_resettime_utc) afresh, give a checkpoint_path. The
+    counters, along with the last device summations and their reset times,
+    are then restored from it on construction, and saved to it every
+    checkpoint_interval_s (as summation records are produced) and on
+    close(). Device summations reported after a restart continue from the
+    restored ones, so no history needs replaying. A missing or unreadable
+    checkpoint is ignored; whether one was used is recorded in restored.
     """
 
-    def __init__(self, with_solar: bool):
+    # pylint: disable=R0913,R0917
+    def __init__(self, with_solar: bool,
+                 instants_keep: int = 31, summations_keep: int = 5,
+                 match_tolerance_s: float = 1.0, allowed_lateness_s: float = 60,
+                 checkpoint_path: Optional[str] = None,
+                 checkpoint_interval_s: float = CHECKPOINT_INTERVAL_S):
         """Constructor.
         with_solar True if it's already known that solar exists. Will be
           automatically enabled upon encountering a solar event during
           processing, but until such a time may generate incorrect values
           for home usage. Similarly, if this is set to True but no solar
           exists, no events may be generated.
+        instants_keep/summations_keep The number of average_power and
+          summation_energy events to buffer per role while waiting for a
+          match. Together these bound the memory used by the instance.
+        match_tolerance_s The maximum difference in starttime_utc for a solar
+          and a house-net reading to be considered the same interval. The
+          default of 1 s pairs everything that pairing by whole second did.
+        allowed_lateness_s How far behind the newest reading seen a reading
+          may arrive and still be paired.
+        checkpoint_path The file to restore the summation state from, and
+          to checkpoint it to.
+        checkpoint_interval_s The minimum time between checkpoints.
         """
         super().__init__()
         self._expect_solar = with_solar
         self._summation = self.SummationInfo(0, 0, 0, 0)
         self._counters = self.Counters(0, 0, 0, 0, 0)
-        self._solar_instants = EventBuffer(31)
-        self._housenet_instants = EventBuffer(31)
-        self._solar_summations = EventBuffer(5)
-        self._housenet_summations = EventBuffer(5)
+        self._last_summation_utc = None
+        self._instants = WatermarkJoin(
+            instants_keep, match_tolerance_s, allowed_lateness_s, same_duration)
+        self._summations = WatermarkJoin(
+            summations_keep, match_tolerance_s, allowed_lateness_s)
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_interval_s = checkpoint_interval_s
+        self._checkpoint_due = time.monotonic() + checkpoint_interval_s
+        self.restored = False
+        if checkpoint_path is not None:
+            self.restored = self.restore_checkpoint()
+
+    def save_checkpoint(self, path: Optional[str] = None):
+        """Atomically writes the summation state to the given path, or the
+        checkpoint_path. Raises OSError on failure."""
+        path = path or self._checkpoint_path
+        summ = self._summation
+        cnt = self._counters
+        last = self._last_summation_utc
+        values = (
+            last, summ.solar_resettime, summ.solar_last,
+            summ.housenet_resettime, summ.housenet_last,
+            cnt.resettime_utc, cnt.solar_generation, cnt.to_grid,
+            cnt.from_grid, cnt.home_use)
+        data = _CHECKPOINT.pack(
+            _CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, int(self._expect_solar),
+            *(math.nan if v is None else v for v in values))
+        data += _CRC.pack(zlib.crc32(data))
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._checkpoint_due = time.monotonic() + self._checkpoint_interval_s
+
+    def restore_checkpoint(self, path: Optional[str] = None) -> bool:
+        """Restores the summation state from the given path, or the
+        checkpoint_path. Returns False, leaving the state untouched, if
+        there's no valid checkpoint."""
+        path = path or self._checkpoint_path
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if len(data) != _CHECKPOINT.size + _CRC.size:
+            return False
+        body = data[:_CHECKPOINT.size]
+        if _CRC.unpack_from(data, _CHECKPOINT.size)[0] != zlib.crc32(body):
+            return False
+        magic, version, solar, *values = _CHECKPOINT.unpack(body)
+        if magic != _CHECKPOINT_MAGIC or version != _CHECKPOINT_VERSION:
+            return False
+        last, *values = [_restore_number(v) for v in values]
+        self._expect_solar = self._expect_solar or bool(solar)
+        self._last_summation_utc = last
+        self._summation = self.SummationInfo(*values[:4])
+        self._counters = self.Counters(*values[4:])
+        return True
+
+    def close(self):
+        """Writes a final checkpoint, if a checkpoint_path was given."""
+        if self._checkpoint_path is not None:
+            self.save_checkpoint()
+
+    @property
+    def join_stats(self) -> dict:
+        """Matched, unmatched and late reading counts, for the 'instants'
+        (average_power) and 'summations' (summation_energy) joins."""
+        return {
+            'instants': self._instants.stats,
+            'summations': self._summations.stats,
+        }
 
     async def process_average_power_event(self, ev: dict):
         """Ingests an event of type 'average_power'."""
         if not KEY_START in ev:
             return
-        starttime_utc = int(ev[KEY_START])
-        if 'role' in ev:
-            role = ev['role']
-            if role == 'house-net':
-                self._housenet_instants.append(ev)
-                await self._process_instants(starttime_utc)
-            elif role == 'solar':
-                if not self._expect_solar:
-                    self._expect_solar = True
-                self._solar_instants.append(ev)
-                await self._process_instants(starttime_utc)
+        role = ev.get('role')
+        if role == 'house-net' and not self._expect_solar:
+            v = make_instant_housenet(self._instants.single(ev))
+            if v is not None:
+                await self._process_instants(v)
+        elif role in ('house-net', 'solar'):
+            if role == 'solar' and not self._expect_solar:
+                self._expect_solar = True
+            pair = self._instants.offer(role, ev)
+            if pair is not None:
+                await self._process_instants(merge_instants(*pair))
 
     async def process_summation_event(self, ev: dict):
         """Ingests an event of type 'summation_energy'."""
         if not KEY_START in ev:
             return
-        starttime_utc = int(ev[KEY_START])
-        if 'role' in ev:
-            role = ev['role']
-            if role == 'house-net':
-                self._housenet_summations.append(ev)
-                await self._process_summations(starttime_utc)
-            elif role == 'solar':
-                if not self._expect_solar:
-                    self._expect_solar = True
-                self._solar_summations.append(ev)
-                await self._process_summations(starttime_utc)
-
-    async def _process_instants(self, starttime_utc: int):
-        if self._expect_solar:
-            v = matching_instants(starttime_utc, self._solar_instants, self._housenet_instants)
-        else:
-            v = make_instant_housenet(self._housenet_instants.find_by_key(KEY_START, starttime_utc))
-        if v is None:
-            return
-
-        self._solar_instants.evict_older(KEY_START, starttime_utc)
-        self._housenet_instants.evict_older(KEY_START, starttime_utc)
-
-        await self.emit('from_grid', {
+        role = ev.get('role')
+        if role == 'house-net' and not self._expect_solar:
+            v = make_summation_housenet(self._summations.single(ev))
+            if v is not None:
+                await self._process_summations(v)
+        elif role in ('house-net', 'solar'):
+            if role == 'solar' and not self._expect_solar:
+                self._expect_solar = True
+            pair = self._summations.offer(role, ev)
+            if pair is not None:
+                await self._process_summations(merge_summations(*pair))
+
+    async def _process_instants(self, v: InstantaneousValues):
+        rec = {
             'timestamp_utc': v.starttime_utc,
-            'watts': v.housenet_watts  if v.housenet_watts > 0 else 0,
-        })
-        await self.emit('home_usage', {
-            'timestamp_utc': v.starttime_utc,
-            'watts': max(v.housenet_watts - v.solar_watts, 0),
-        })
+            'duration_s': v.duration_s,
+            'from_grid_watts': v.housenet_watts  if v.housenet_watts > 0 else 0,
+            'home_usage_watts': max(v.housenet_watts - v.solar_watts, 0),
+        }
         if self._expect_solar:
-            await self.emit('solar_generation', {
-                'timestamp_utc': v.starttime_utc,
-                'watts': max(-v.solar_watts, 0),
-            })
-            await self.emit('to_grid', {
-                'timestamp_utc': v.starttime_utc,
-                'watts': -v.housenet_watts if v.housenet_watts < 0 else 0,
-            })
-
-    async def _process_summations(self, starttime_utc: int):
-        if self._expect_solar:
-            v = matching_summations(
-                starttime_utc,
-                self._solar_summations,
-                self._housenet_summations)
-        else:
-            v = make_summation_housenet(
-                self._housenet_summations.find_by_key(KEY_START, starttime_utc))
-        if v is None:
-            return
+            rec['solar_generation_watts'] = max(-v.solar_watts, 0)
+            rec['to_grid_watts'] = -v.housenet_watts if v.housenet_watts < 0 else 0
+
+        await self.emit('household_power', rec)
+        await self._emit_split({
+            'timestamp_utc': rec['timestamp_utc'],
+        }, rec, 'watts', {
+            'from_grid': 'from_grid_watts',
+            'home_usage': 'home_usage_watts',
+            'solar_generation': 'solar_generation_watts',
+            'to_grid': 'to_grid_watts',
+        })
 
-        self._solar_summations.evict_older(KEY_START, starttime_utc)
-        self._housenet_summations.evict_older(KEY_START, starttime_utc)
+    async def _process_summations(self, v: SummationValues):
+        starttime_utc = v.starttime_utc
+        # Deltas are only meaningful in time order
+        if self._last_summation_utc is not None and \
+                starttime_utc <= self._last_summation_utc:
+            self._summations.stats.late += 1
+            return
+        self._last_summation_utc = starttime_utc
 
         if not self._resettime_validation(v, starttime_utc):
             return
@@ -242,27 +423,43 @@ class VirtualHousehold(AsyncEventEmitter):
         deltas = self._calculate_summation_deltas(v)
         self._increment_counters(deltas)
 
-        await self.emit('from_grid_summation', {
+        rec = {
             'timestamp_utc': starttime_utc,
             'summation_resettime_utc': self._counters.resettime_utc,
-            'summation_joules': self._counters.from_grid,
-        })
-        await self.emit('home_usage_summation', {
-            'timestamp_utc': starttime_utc,
-            'summation_resettime_utc': self._counters.resettime_utc,
-            'summation_joules': self._counters.home_use,
-        })
+            'from_grid_joules': self._counters.from_grid,
+            'home_usage_joules': self._counters.home_use,
+        }
         if self._expect_solar:
-            await self.emit('solar_generation_summation', {
-                'timestamp_utc': starttime_utc,
-                'summation_resettime_utc': self._counters.resettime_utc,
-                'summation_joules': self._counters.solar_generation,
-            })
-            await self.emit('to_grid_summation', {
-                'timestamp_utc': starttime_utc,
-                'summation_resettime_utc': self._counters.resettime_utc,
-                'summation_joules': self._counters.to_grid,
-            })
+            rec['solar_generation_joules'] = self._counters.solar_generation
+            rec['to_grid_joules'] = self._counters.to_grid
+
+        if self._checkpoint_path is not None and \
+                time.monotonic() >= self._checkpoint_due:
+            try:
+                self.save_checkpoint()
+            except OSError as e:
+                self._checkpoint_due = time.monotonic() + self._checkpoint_interval_s
+                await self.emit('exception', e)
+
+        await self.emit('household_summation', rec)
+        await self._emit_split({
+            'timestamp_utc': rec['timestamp_utc'],
+            'summation_resettime_utc': rec['summation_resettime_utc'],
+        }, rec, 'summation_joules', {
+            'from_grid_summation': 'from_grid_joules',
+            'home_usage_summation': 'home_usage_joules',
+            'solar_generation_summation': 'solar_generation_joules',
+            'to_grid_summation': 'to_grid_joules',
+        })
+
+    async def _emit_split(self, base: dict, rec: dict, valkey: str, fields: dict):
+        """Emits the individual per-flow events of a combined record, for
+        any which have subscribers."""
+        for name, field in fields.items():
+            if field in rec and self.has_listeners(name):
+                ev = dict(base)
+                ev[valkey] = rec[field]
+                await self.emit(name, ev)
 
     def _resettime_validation(self, v: SummationValues, starttime_utc: int) -> bool:
         res = True
@@ -0,0 +1,69 @@
+"""A shared, coarse-grained timer for supervising many listeners."""
+import asyncio
+import time
+
+TICK_S = 1.0
+
+class Watchdog:
+    """
+    Calls on_watchdog_tick(now) on each registered member every tick_s
+    seconds, with now being the time.monotonic() timestamp of the tick.
+
+    Rather than each member maintaining its own timers (and re-arming them
+    e.g. on every received packet), members record plain timestamps and
+    check them against now on each tick. This keeps a single entry in the
+    event loop's timer heap, regardless of the number of members. Timeouts
+    are consequently only accurate to within one tick.
+
+    Use for_running_loop() to obtain the instance shared by all members
+    within the running event loop. The instance goes away again once its
+    last member has unregistered.
+    """
+
+    _instances = {} # loop -> Watchdog
+
+    def __init__(self, tick_s: float = TICK_S):
+        self._tick_s = tick_s
+        self._members = {}
+        self._handle = None
+        self._loop = None
+
+    @classmethod
+    def for_running_loop(cls) -> 'Watchdog':
+        """Returns the watchdog shared within the running event loop."""
+        loop = asyncio.get_running_loop()
+        watchdog = cls._instances.get(loop)
+        if watchdog is None:
+            watchdog = cls._instances[loop] = cls()
+            watchdog._loop = loop
+        return watchdog
+
+    def register(self, member):
+        """Adds a member, which must provide on_watchdog_tick(now)."""
+        self._members[member] = None
+        if self._handle is None:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+            Watchdog._instances.setdefault(self._loop, self)
+            self._handle = self._loop.call_later(self._tick_s, self._tick)
+
+    def unregister(self, member):
+        """Removes a member. Unknown members are ignored."""
+        self._members.pop(member, None)
+        if not self._members:
+            if self._handle is not None:
+                self._handle.cancel()
+                self._handle = None
+            if Watchdog._instances.get(self._loop) is self:
+                del Watchdog._instances[self._loop]
+
+    def __len__(self):
+        return len(self._members)
+
+    def _tick(self):
+        self._handle = None
+        now = time.monotonic()
+        for member in list(self._members):
+            member.on_watchdog_tick(now)
+        if self._members and self._handle is None:
+            self._handle = self._loop.call_later(self._tick_s, self._tick)
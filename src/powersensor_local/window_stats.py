@@ -0,0 +1,206 @@
+"""Rolling per-device statistics over time-based windows."""
+import math
+import sys
+from collections import deque
+from typing import Iterable, Optional
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter
+
+# Event name -> the field tracked from it
+FIELDS = {
+    'average_power': 'watts',
+    'average_flow': 'litres_per_minute',
+    'radio_signal_quality': 'average_rssi',
+}
+
+class Window:
+    """Running statistics of a single value over the trailing window_s
+    seconds. Samples are weighted by their duration, and expire once their
+    end time falls outside the window.
+
+    Sums are maintained incrementally, and the minimum and maximum via
+    monotonic deques, so adding a sample is amortised O(1), and so are
+    queries. Samples must be added in time order.
+    """
+    __slots__ = ('window_s', 'samples', 'mins', 'maxs', 'weight', 'total', 'total_sq')
+
+    def __init__(self, window_s: float):
+        self.window_s = window_s
+        self.samples = deque() # (end time, value, weight)
+        self.mins = deque() # (end time, value), values increasing
+        self.maxs = deque() # (end time, value), values decreasing
+        self.weight = 0.0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, end: float, value: float, weight: float):
+        """Adds a sample, and expires those which fall out of the window."""
+        self.samples.append((end, value, weight))
+        self.weight += weight
+        self.total += value * weight
+        self.total_sq += value * value * weight
+        mins = self.mins
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((end, value))
+        maxs = self.maxs
+        while maxs and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((end, value))
+        self.expire(end)
+
+    def expire(self, now: float):
+        """Drops the samples which ended at or before now - window_s."""
+        cutoff = now - self.window_s
+        samples = self.samples
+        while samples and samples[0][0] <= cutoff:
+            _, value, weight = samples.popleft()
+            self.weight -= weight
+            self.total -= value * weight
+            self.total_sq -= value * value * weight
+        if not samples:
+            # Don't let rounding errors accumulate across idle periods
+            self.weight = self.total = self.total_sq = 0.0
+        while self.mins and self.mins[0][0] <= cutoff:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] <= cutoff:
+            self.maxs.popleft()
+
+    def as_dict(self) -> Optional[dict]:
+        """Returns count, mean, min, max and stddev, or None if empty."""
+        if not self.samples or self.weight <= 0:
+            return None
+        mean = self.total / self.weight
+        variance = max(self.total_sq / self.weight - mean * mean, 0.0)
+        return {
+            'count': len(self.samples),
+            'mean': mean,
+            'min': self.mins[0][1],
+            'max': self.maxs[0][1],
+            'stddev': math.sqrt(variance),
+        }
+
+    def memory_bytes(self) -> int:
+        """Approximates the memory used by the window."""
+        size = (sys.getsizeof(self) + sys.getsizeof(self.samples)
+                + sys.getsizeof(self.mins) + sys.getsizeof(self.maxs))
+        if self.samples:
+            size += len(self.samples) * sys.getsizeof(self.samples[0])
+            size += (len(self.mins) + len(self.maxs)) * sys.getsizeof(self.mins[0])
+        return size
+
+class WindowedStats:
+    """
+    Maintains rolling mean/min/max/stddev of watts, litres_per_minute and
+    average_rssi per device, over one or more trailing time windows.
+
+    Time is taken from the events rather than the clock: a sample spans
+    starttime_utc to starttime_utc + duration_s, and a window covers the
+    window_s seconds up to the end of the latest sample of that device.
+    Samples are weighted by their duration (1 s if absent). Samples which
+    don't start after the previous one of the same device and field, e.g.
+    copies relayed by a second plug, are counted in late and ignored.
+
+    Updates and queries are amortised O(1). Memory grows with the window
+    length and the event rate, see memory_usage().
+
+    The instance may be subscribed directly to one or more PlugApi instances
+    (see attach()), or fed via process_event().
+    """
+
+    def __init__(self, windows_s: Iterable[float] = (60,)):
+        """Constructor.
+        windows_s The window lengths to maintain, in seconds.
+        """
+        self._windows_s = tuple(windows_s)
+        if not self._windows_s:
+            raise ValueError('at least one window is required')
+        self._series = {} # (mac, field) -> [last starttime, {window_s: Window}]
+        self.late = 0
+
+    @property
+    def windows_s(self) -> tuple:
+        """The window lengths maintained, in seconds."""
+        return self._windows_s
+
+    def attach(self, emitter: AsyncEventEmitter):
+        """Subscribes to the relevant events on e.g. a PlugApi instance."""
+        for name in FIELDS:
+            emitter.subscribe(name, self.process_event)
+
+    def detach(self, emitter: AsyncEventEmitter):
+        """Reverses attach()."""
+        for name in FIELDS:
+            emitter.unsubscribe(name, self.process_event)
+
+    async def process_event(self, event_name: str, ev: dict):
+        """update() in the form of an AsyncEventEmitter handler."""
+        self.update(event_name, ev)
+
+    def update(self, event_name: str, ev: dict):
+        """Adds the tracked value of an event. Other events are ignored."""
+        field = FIELDS.get(event_name)
+        if field is None:
+            return
+        value = ev.get(field)
+        start = ev.get('starttime_utc')
+        mac = ev.get('mac')
+        if value is None or start is None or mac is None:
+            return
+        key = (mac, field)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [
+                None, { w: Window(w) for w in self._windows_s }]
+        elif start <= series[0]:
+            self.late += 1
+            return
+        series[0] = start
+        duration = ev.get('duration_s') or 1
+        end = start + duration
+        for window in series[1].values():
+            window.add(end, value, duration)
+
+    def stats(self, mac: str, field: str = 'watts', window_s: Optional[float] = None,
+              now: Optional[float] = None) -> Optional[dict]:
+        """Returns the statistics for a device and field over the given
+        window (by default the first one), or None if there are none.
+        If now (in UTC seconds) is given, samples older than the window
+        relative to it are expired first, e.g. for devices gone quiet."""
+        series = self._series.get((mac, field))
+        if series is None:
+            return None
+        window = series[1].get(self._windows_s[0] if window_s is None else window_s)
+        if window is None:
+            raise KeyError(f'No {window_s} s window')
+        if now is not None:
+            window.expire(now)
+        return window.as_dict()
+
+    def all_stats(self) -> dict:
+        """Returns all statistics, as { mac: { field: { window_s: stats }}}."""
+        out = {}
+        for (mac, field), series in self._series.items():
+            out.setdefault(mac, {})[field] = {
+                w: window.as_dict() for w, window in series[1].items() }
+        return out
+
+    def remove(self, mac: str):
+        """Forgets all statistics for a device."""
+        for field in FIELDS.values():
+            self._series.pop((mac, field), None)
+
+    def memory_usage(self) -> dict:
+        """Returns the number of series and samples held, and the
+        approximate number of bytes used by them."""
+        samples = 0
+        size = sys.getsizeof(self._series)
+        for series in self._series.values():
+            for window in series[1].values():
+                samples += len(window.samples)
+                size += window.memory_bytes()
+        return {
+            'series': len(self._series),
+            'samples': samples,
+            'bytes': size,
+        }
@@ -0,0 +1,51 @@
+"""Tests for EventStream."""
+import asyncio
+import unittest
+
+from powersensor_local.async_event_emitter import AsyncEventEmitter, EventStream
+
+
+class EventStreamBlockTests(unittest.IsolatedAsyncioTestCase):
+    """The 'block' overflow policy."""
+
+    async def test_close_releases_blocked_push(self):
+        """Closing a full stream frees a push waiting for space."""
+        stream = EventStream(maxsize=1, overflow='block')
+        await stream.push('a', 1)
+        blocked = asyncio.create_task(stream.push('b', 2))
+        await asyncio.sleep(0.01)
+        self.assertFalse(blocked.done())
+
+        stream.close()
+        await asyncio.wait((blocked,), timeout=0.5)
+        self.assertTrue(blocked.done())
+
+        # The queued event is still delivered; the blocked one is dropped
+        self.assertEqual([item async for item in stream], [('a', 1)])
+
+    async def test_close_releases_blocked_emitter(self):
+        """Leaving the async with block frees the emitter."""
+        emitter = AsyncEventEmitter()
+        async with EventStream(maxsize=1, overflow='block') as stream:
+            emitter.subscribe('ev', stream.push)
+            await emitter.emit('ev', 1)
+            blocked = asyncio.create_task(emitter.emit('ev', 2))
+            await asyncio.sleep(0.01)
+        # Not wait_for(), as the emitter would swallow its cancellation
+        await asyncio.wait((blocked,), timeout=0.5)
+        self.assertTrue(blocked.done())
+
+    async def test_blocked_push_completes_when_consumed(self):
+        """A blocked push is queued once space frees up."""
+        stream = EventStream(maxsize=1, overflow='block')
+        await stream.push('a', 1)
+        blocked = asyncio.create_task(stream.push('b', 2))
+        await asyncio.sleep(0.01)
+        self.assertEqual(await anext(stream), ('a', 1))
+        await asyncio.wait((blocked,), timeout=0.5)
+        self.assertTrue(blocked.done())
+        self.assertEqual(stream.get_nowait(), ('b', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()